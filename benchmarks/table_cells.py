@@ -0,0 +1,94 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare the speed of the per-row and columnar table cell code
+on a synthetic calibrate_metadata_metricsTable.
+
+Usage: BUTLER_REPO_NAMES=embargo python benchmarks/table_cells.py [n_rows]
+
+The package reads BUTLER_REPO_NAMES on import, but no repository is used.
+"""
+
+import sys
+import time
+
+import numpy as np
+from astropy.table import Table
+
+from lsst.production.tools.htmlUtils import make_table_cells, make_table_cells_per_row, make_table_headers
+from lsst.production.tools.tableLayouts import get_table_layout
+
+TABLE_NAME = "calibrate_metadata_metricsTable"
+
+
+def make_visit_table(n_rows, col_dict, prefix, seed=0):
+    rng = np.random.default_rng(seed)
+    t = Table()
+    t["visit"] = np.arange(n_rows) // 189 + 2024010100000
+    t["day_obs"] = np.full(n_rows, 20240101)
+    t["detector"] = np.arange(n_rows) % 189
+    t["band"] = np.array(["g", "r", "i"])[rng.integers(0, 3, n_rows)]
+    for col in col_dict["footprint_cols"]:
+        t[f"{prefix}_{col}_footprint_count"] = rng.integers(0, 1000, n_rows).astype(float)
+    for col in col_dict["source_cols"]:
+        name = f"{prefix}_{col}_source_count" if col else f"{prefix}_source_count"
+        t[name] = rng.integers(0, 5000, n_rows).astype(float)
+    for col in col_dict["mask_cols"]:
+        t[f"{prefix}_{col}_mask_fraction"] = rng.random(n_rows)
+        t[f"{prefix}_{col}_mask_fraction"][rng.random(n_rows) < 0.01] = np.nan
+    return t
+
+
+def make_metric_defs(t):
+    metric_defs = {}
+    for col in t.colnames[4::2]:
+        low, high = np.nanpercentile(t[col], [2, 98])
+        metric_defs[col] = {"lowThreshold": low, "highThreshold": high, "debugGroup": "calexp"}
+    return metric_defs
+
+
+def main(n_rows):
+    col_dict, headers, prefix = get_table_layout(TABLE_NAME)
+    t = make_visit_table(n_rows, col_dict, prefix)
+    metric_defs = make_metric_defs(t)
+    _, bands = make_table_headers(t, headers)
+
+    start = time.perf_counter()
+    per_row = make_table_cells_per_row(t, col_dict, bands, metric_defs, prefix)
+    per_row_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columnar = make_table_cells(t, col_dict, bands, metric_defs, prefix)
+    columnar_time = time.perf_counter() - start
+
+    same = per_row.keys() == columnar.keys() and all(
+        [vars(cell) for cell in per_row[key]] == [vars(cell) for cell in columnar[key]]
+        for key in per_row
+    )
+
+    print(f"{n_rows} rows, {len(t.colnames)} columns")
+    print(f"per row:  {per_row_time:.2f}s")
+    print(f"columnar: {columnar_time:.2f}s ({per_row_time / columnar_time:.1f}x)")
+    print(f"identical output: {same}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -23,7 +23,7 @@ from flask import Flask, render_template
 import urllib.parse
 from werkzeug.routing import BaseConverter
 
-from . import tractTable, logs, bokeh, cache, images, htmlUtils
+from . import tractTable, logs, bokeh, cache, images, htmlUtils, butlerPool
 
 
 # This works like the built-in 'path' converter, but
@@ -51,6 +51,7 @@ def create_app():
     app.register_blueprint(cache.bp)
     app.register_blueprint(images.bp)
 
+    butlerPool.init_app(app)
 
     @app.route("/")
     def index():
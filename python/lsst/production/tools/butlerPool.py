@@ -0,0 +1,187 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from lsst.daf.butler import Butler
+
+
+class ButlerPool:
+    """Process-wide Butlers, one set per repository.
+
+    Each repository gets one Butler, made the first time it is needed
+    or by `warm_up`. Callers are handed clones of it, which share its
+    caches and registry connection pool, and at most ``max_per_repo``
+    clones of a repository are in use at any one time.
+
+    Parameters
+    ----------
+    max_per_repo : `int`
+        Maximum number of Butlers in use per repository.
+    timeout : `float`, optional
+        Seconds to wait for a Butler before giving up, or None to
+        wait for as long as it takes.
+    """
+
+    def __init__(self, max_per_repo=4, timeout=None):
+        self.max_per_repo = max_per_repo
+        self.timeout = timeout
+        self._butlers = {}
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._repo_locks = {}
+
+    def _repo_lock(self, repo):
+        with self._lock:
+            if repo not in self._repo_locks:
+                self._repo_locks[repo] = threading.Lock()
+                self._idle[repo] = []
+                self._slots[repo] = threading.BoundedSemaphore(self.max_per_repo)
+            return self._repo_locks[repo]
+
+    def get(self, repo):
+        """Return the shared Butler for a repository, making it if needed.
+
+        Parameters
+        ----------
+        repo : `str`
+            Butler repository.
+
+        Returns
+        -------
+        butler : `lsst.daf.butler.Butler`
+        """
+        butler = self._butlers.get(repo)
+        if butler is None:
+            with self._repo_lock(repo):
+                butler = self._butlers.get(repo)
+                if butler is None:
+                    print(f"Instantiating a butler for {repo}")
+                    butler = Butler(repo)
+                    self._butlers[repo] = butler
+        return butler
+
+    def acquire(self, repo):
+        """Take a Butler for a repository out of the pool, waiting if
+        ``max_per_repo`` are already in use.
+
+        Parameters
+        ----------
+        repo : `str`
+            Butler repository.
+
+        Returns
+        -------
+        butler : `lsst.daf.butler.Butler`
+            A clone of the shared Butler, to be given back with `release`.
+        """
+        root = self.get(repo)
+        if not self._slots[repo].acquire(timeout=self.timeout):
+            raise TimeoutError(f"No Butler available for {repo}")
+        with self._repo_lock(repo):
+            if self._idle[repo]:
+                return self._idle[repo].pop()
+        try:
+            return root.clone()
+        except Exception:
+            self._slots[repo].release()
+            raise
+
+    def release(self, repo, butler):
+        """Return a Butler taken with `acquire` to the pool.
+        """
+        with self._repo_lock(repo):
+            self._idle[repo].append(butler)
+        self._slots[repo].release()
+
+    @contextmanager
+    def butler(self, repo):
+        """Use a Butler from the pool for the duration of a with block.
+        """
+        butler = self.acquire(repo)
+        try:
+            yield butler
+        finally:
+            self.release(repo, butler)
+
+    def warm_up(self, repos):
+        """Make the shared Butler for each repository now, rather than
+        during the first request that needs it.
+        """
+        for repo in repos:
+            try:
+                self.get(repo)
+            except Exception as e:
+                print(f"Could not make a butler for {repo}: {e}")
+
+    def warm_up_in_background(self, repos):
+        threading.Thread(target=self.warm_up, args=(list(repos),),
+                         name="butler-warm-up", daemon=True).start()
+
+
+butler_pool = ButlerPool(max_per_repo=int(os.getenv("BUTLER_POOL_SIZE", "4")),
+                         timeout=float(os.getenv("BUTLER_POOL_TIMEOUT", "60")))
+
+
+def request_butler(repo):
+    """Return a pooled Butler for use during the current request.
+
+    The same Butler is returned for every call with the same repo
+    during a request, and it goes back to the pool when the request's
+    app context is torn down.
+    """
+    if not has_app_context():
+        return butler_pool.get(repo)
+
+    if "butlers" not in g:
+        g.butlers = {}
+    if repo not in g.butlers:
+        g.butlers[repo] = butler_pool.acquire(repo)
+    return g.butlers[repo]
+
+
+def release_request_butler(repo):
+    """Give the current request's Butler for a repo back to the pool
+    before the request ends, for work that no longer needs it.
+    """
+    if has_app_context() and repo in g.get("butlers", {}):
+        butler_pool.release(repo, g.butlers.pop(repo))
+
+
+def release_request_butlers(exception=None):
+    for repo, butler in g.pop("butlers", {}).items():
+        butler_pool.release(repo, butler)
+
+
+def init_app(app):
+    """Give request Butlers back to the pool at the end of each request,
+    and start making the Butlers for ``$BUTLER_REPO_NAMES`` as the
+    worker starts.
+    """
+    app.teardown_appcontext(release_request_butlers)
+
+    repo_names = os.getenv("BUTLER_REPO_NAMES", "")
+    if os.getenv("BUTLER_POOL_WARM_UP", "true").lower() in ("true", "1", "yes"):
+        butler_pool.warm_up_in_background(x for x in repo_names.split(",") if x)
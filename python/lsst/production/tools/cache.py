@@ -21,6 +21,7 @@
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import lsst.daf.butler as dafButler
 from flask import Blueprint, Flask, jsonify, request, abort
@@ -29,9 +30,18 @@ import time
 
 import json
 import gzip
+import hashlib
 import urllib.parse
+from datetime import datetime, timezone
 import boto3
 import botocore
+from lsst.resources import ResourcePath
+
+from .butlerPool import butler_pool
+from .cacheUtils import read_png_metadata
+from .htmlUtils import metric_defs_key
+from .metricDefs import get_metric_defs
+from .metricRollups import rollup_collection, write_metric_rollups
 
 bp = Blueprint("cache", __name__, url_prefix="/plot-navigator/cache", static_folder="../../../../static")
 
@@ -51,12 +61,27 @@ async def index():
 
         data = request.get_json()
         arq_job = await redis.enqueue_job("cache_plots", data['repo'], data['collection'],
-                                          data.get("filter_collections", False))
+                                          data.get("filter_collections", False),
+                                          data.get("index_metadata", False))
         return jsonify({"jobId": arq_job.job_id})
 
     else:
         abort(400, description=f"Invalid HTTP Method {request.method}")
 
+# PUT /cache/rollups  {repo: "", collection: ""}, return {jobId: ""}
+
+@bp.route("/rollups", methods=["PUT"])
+async def rollups():
+    redis_settings = arq.connections.RedisSettings(host=os.getenv("REDIS_HOST"),
+                                                   port=os.getenv("REDIS_PORT"),
+                                                   password=os.getenv("REDIS_PASSWORD"))
+
+    redis = await arq.create_pool(redis_settings)
+    print(f"cache.rollups() received request: {request}")
+    data = request.get_json()
+    arq_job = await redis.enqueue_job("cache_metric_rollups", data['repo'], data['collection'])
+    return jsonify({"jobId": arq_job.job_id})
+
 @bp.route("/job/<job_id>")
 async def job(job_id):
 
@@ -72,7 +97,7 @@ async def job(job_id):
     return jsonify({"status": await arq_job.status(),
                     "result": job_result.result if job_result is not None else ""})
 
-async def cache_plots(ctx, repo, collection, filter_collections=False):
+async def cache_plots(ctx, repo, collection, filter_collections=False, index_metadata=False):
     """
     Generate the plot cache file and write it to S3.
 
@@ -87,17 +112,22 @@ async def cache_plots(ctx, repo, collection, filter_collections=False):
     filter_collections : bool, optional
        Only include plots in run collections named with the same prefix as `collection`.
 
+    index_metadata : bool, optional
+       Read the PNG text chunks of every plot and store the image
+       metadata alongside each ref, so that it can be served without
+       opening the image.
+
     Returns
     -------
     string
        Success or error message.
     """
 
-    butler = dafButler.Butler(repo)
-
     try:
-        summary = summarize_collection(butler, collection,
-                                       filter_prefix=collection if filter_collections else "")
+        with butler_pool.butler(repo) as butler:
+            summary = summarize_collection(butler, collection,
+                                           filter_prefix=collection if filter_collections else "",
+                                           index_metadata=index_metadata)
     except dafButler.MissingCollectionError as e:
         return f"Error: Collection '{collection}' not found in {repo} repo."
 
@@ -117,20 +147,256 @@ async def cache_plots(ctx, repo, collection, filter_collections=False):
     except botocore.exceptions.ClientError as e:
         return f"Error: {e}"
 
+    plot_counts = {section: sum(len(ref_dicts) for ref_dicts in summary[section].values())
+                   for section in summary}
+    manifest_entry = {"collection": collection,
+                      "updated": datetime.now(timezone.utc).isoformat(),
+                      "plot_counts": plot_counts,
+                      "compressed_size": len(json_gzipped),
+                      "sha256": hashlib.sha256(json_string.encode()).hexdigest()}
+    try:
+        update_manifest(s3_client, repo, manifest_entry)
+    except (botocore.exceptions.ClientError, RuntimeError) as e:
+        print(f"Could not update the manifest for {repo}: {e}")
 
     n_plots = len(summary['tracts']) + len(summary['visits']) + len(summary['global'])
     return f"Success: {n_plots} plots"
 
+async def cache_metric_rollups(ctx, repo, collection):
+    """
+    Check every metrics table in a collection against the metric
+    thresholds and write the failure rollups to S3.
+
+    Parameters
+    ----------
+    repo : string
+       Butler repository
+
+    collection : string
+       Butler collection to search for metrics tables.
+
+    Returns
+    -------
+    string
+       Success or error message.
+    """
+
+    metric_defs = get_metric_defs()
+    try:
+        with butler_pool.butler(repo) as butler:
+            tables = rollup_collection(butler, collection, metric_defs)
+    except dafButler.MissingCollectionError as e:
+        return f"Error: Collection '{collection}' not found in {repo} repo."
+
+    session = boto3.Session(profile_name='rubin-plot-navigator')
+    s3_client = session.client('s3', endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+
+    try:
+        write_metric_rollups(s3_client, repo, collection, tables, metric_defs_key(metric_defs))
+    except botocore.exceptions.ClientError as e:
+        return f"Error: {e}"
+
+    n_failures = sum(table["n_failures"] for table in tables.values())
+    return f"Success: {len(tables)} tables, {n_failures} failures"
+
+async def startup(ctx):
+    butler_pool.warm_up(x for x in os.getenv("BUTLER_REPO_NAMES", "").split(",") if x)
+
 class Worker:
-    functions = [cache_plots]
+    functions = [cache_plots, cache_metric_rollups]
+    on_startup = startup
     redis_settings = arq.connections.RedisSettings(host=os.getenv("REDIS_HOST"),
                                                    port=os.getenv("REDIS_PORT"),
                                                    password=os.getenv("REDIS_PASSWORD"))
 
 
-def summarize_collection(butler, collection_name, filter_prefix=""):
+def manifest_key(repo):
+    return f"{urllib.parse.quote_plus(repo)}/manifest.json"
+
+def list_cache_files(s3_client, repo):
+    """
+    List the plot cache files of a repo in the bucket.
+
+    Parameters
+    ----------
+    s3_client : `botocore.client.S3`
+       Client for the plot navigator bucket.
+
+    repo : string
+       Butler repository
+
+    Returns
+    -------
+    list of tuple
+       Pairs of (collection name, time the cache file was last modified).
+    """
+
+    prefix = urllib.parse.quote_plus(repo) + "/collection_"
+
+    cache_files = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for response in paginator.paginate(Bucket='rubin-plot-navigator', Prefix=prefix):
+        for entry in response.get("Contents", []):
+            collection_enc = entry["Key"][len(prefix):].replace(".json.gz", "")
+            cache_files.append((urllib.parse.unquote(collection_enc), entry["LastModified"]))
+
+    return cache_files
+
+def read_manifest(s3_client, repo):
+    """
+    Read the collection manifest of a repo.
+
+    Parameters
+    ----------
+    s3_client : `botocore.client.S3`
+       Client for the plot navigator bucket.
+
+    repo : string
+       Butler repository
+
+    Returns
+    -------
+    manifest : dict or None
+       Manifest entries keyed by collection name, or None if the
+       repo has no manifest yet.
+
+    etag : string or None
+       ETag of the manifest object.
+    """
+
+    try:
+        response = s3_client.get_object(Bucket='rubin-plot-navigator', Key=manifest_key(repo))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+
+    return json.loads(response['Body'].read())['collections'], response['ETag']
+
+def update_manifest(s3_client, repo, entry, max_attempts=5):
+    """
+    Add or replace one collection in the manifest of a repo.
+
+    The manifest is rewritten with a conditional put against the ETag
+    it was read with, and re-read and retried if another job changed it
+    in between, so concurrent cache jobs cannot drop each other's entries.
+
+    Parameters
+    ----------
+    s3_client : `botocore.client.S3`
+       Client for the plot navigator bucket.
+
+    repo : string
+       Butler repository
+
+    entry : dict
+       Manifest entry; entry["collection"] is the collection name.
+
+    max_attempts : int, optional
+       Number of times to try before giving up.
+    """
+
+    for attempt in range(max_attempts):
+        manifest, etag = read_manifest(s3_client, repo)
+        if manifest is None:
+            # Seed a new manifest with the collections cached before
+            # there was one, so they stay in the listing.
+            manifest = {collection: {"collection": collection, "updated": updated.isoformat()}
+                        for collection, updated in list_cache_files(s3_client, repo)}
+            condition = {"IfNoneMatch": "*"}
+        else:
+            condition = {"IfMatch": etag}
+        manifest[entry["collection"]] = entry
+
+        body = json.dumps({"collections": manifest}).encode()
+        try:
+            s3_client.put_object(Body=body, Bucket='rubin-plot-navigator', Key=manifest_key(repo),
+                                 ContentType="application/json", **condition)
+            return
+        except botocore.exceptions.ParamValidationError:
+            # Older botocore releases do not know IfMatch/IfNoneMatch.
+            print("Conditional puts are not supported, writing the manifest unconditionally")
+            s3_client.put_object(Body=body, Bucket='rubin-plot-navigator', Key=manifest_key(repo),
+                                 ContentType="application/json")
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            time.sleep(0.1 * 2**attempt)
+
+    raise RuntimeError(f"Could not update the manifest for {repo} after {max_attempts} attempts")
+
+def read_collection_summary(repo, collection):
+    """
+    Read a plot cache file written by `cache_plots` back from S3.
+
+    Parameters
+    ----------
+    repo : string
+       Butler repository
+
+    collection : string
+       Butler collection the cache file was made for.
+
+    Returns
+    -------
+    dict or None
+       The collection summary, or None if there is no cache file.
+    """
+
+    encoded_collection_name = urllib.parse.quote_plus(collection)
+    encoded_repo = urllib.parse.quote_plus(repo)
+    filename = f"{encoded_repo}/collection_{encoded_collection_name}.json.gz"
+
+    session = boto3.Session(profile_name='rubin-plot-navigator')
+    s3_client = session.client('s3', endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+
+    try:
+        response = s3_client.get_object(Bucket='rubin-plot-navigator', Key=filename)
+    except botocore.exceptions.ClientError as e:
+        print(e)
+        return None
+
+    return json.loads(gzip.decompress(response['Body'].read()))
+
+
+def index_plot_metadata(butler, indexed_refs, max_workers=None):
+    """
+    Add the PNG metadata of each plot to its cache entry.
+
+    Only the PNG header and text chunks are read, not the pixel data.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+       Butler to look up the plot URIs with.
+
+    indexed_refs : list of tuple
+       Pairs of (ref_dict, datasetRef); each ref_dict is updated in place.
+
+    max_workers : int, optional
+       Number of concurrent reads, defaults to $METADATA_INDEX_THREADS or 16.
+    """
+
+    if max_workers is None:
+        max_workers = int(os.getenv("METADATA_INDEX_THREADS", "16"))
+
+    def read_one(ref_dict, dataset_ref):
+        try:
+            ref_dict.update(read_png_metadata(ResourcePath(butler.getURI(dataset_ref))))
+        except Exception as e:
+            print(f"Could not read metadata for {dataset_ref.id}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(read_one, ref_dict, dataset_ref)
+                       for ref_dict, dataset_ref in indexed_refs]:
+            future.result()
+
+
+def summarize_collection(butler, collection_name, filter_prefix="", index_metadata=False):
 
     out = {}
+    indexed_refs = []
 
     summary = butler.registry.getCollectionSummary(collection_name)
 
@@ -142,27 +408,36 @@ def summarize_collection(butler, collection_name, filter_prefix=""):
     tract_datasets = list(butler.registry.queryDatasets(tract_plot_types, collections=collection_name, findFirst=True))
     out['tracts'] = {}
     for plot_type in tract_plot_types:
-        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in tract_datasets
-                     if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        refs = [datasetRef for datasetRef in tract_datasets
+                if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in refs]
+        indexed_refs.extend(zip(ref_dicts, refs))
         if(len(ref_dicts) > 0):
             out['tracts'][plot_type.name] = ref_dicts
 
     visit_datasets = list(butler.registry.queryDatasets(visit_plot_types, collections=collection_name, findFirst=True))
     out['visits'] = {}
     for plot_type in visit_plot_types:
-        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in visit_datasets
-                     if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        refs = [datasetRef for datasetRef in visit_datasets
+                if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in refs]
+        indexed_refs.extend(zip(ref_dicts, refs))
         if(len(ref_dicts) > 0):
             out['visits'][plot_type.name] = ref_dicts
 
     global_datasets = list(butler.registry.queryDatasets(global_plot_types, collections=collection_name, findFirst=True))
     out['global'] = {}
     for plot_type in global_plot_types:
-        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in global_datasets
-                     if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        refs = [datasetRef for datasetRef in global_datasets
+                if datasetRef.datasetType == plot_type and datasetRef.run.startswith(filter_prefix)]
+        ref_dicts = [{"dataId": json.dumps(dict(datasetRef.dataId.mapping)), "id": str(datasetRef.id)} for datasetRef in refs]
+        indexed_refs.extend(zip(ref_dicts, refs))
         if(len(ref_dicts) > 0):
             out['global'][plot_type.name] = ref_dicts
 
+    if index_metadata:
+        index_plot_metadata(butler, indexed_refs)
+
     #print("Tract plots: {:d}".format(len(out['tracts'])))
     #print("Visit plots: {:d}".format(len(out['visits'])))
     #print("Global plots: {:d}".format(len(out['global'])))
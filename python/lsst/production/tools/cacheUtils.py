@@ -0,0 +1,130 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class LRUCache:
+    """A small thread-safe least-recently-used cache.
+
+    Parameters
+    ----------
+    maxsize : `int`
+        Maximum number of entries to keep.
+    ttl : `float`, optional
+        Number of seconds after which an entry is treated as
+        missing. Entries never expire if this is None.
+    maxbytes : `int`, optional
+        Maximum total size of the entries, as measured by `sizeof`.
+    sizeof : callable, optional
+        Returns the size in bytes of a value; required with `maxbytes`.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, stored, size = self._entries[key]
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic(), size)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes and len(self._entries) > 1
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        value, _, size = self._entries.pop(key)
+        self.nbytes -= size
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+_missing = object()
+
+
+def read_png_metadata(resource_path):
+    """Read the metadata of a PNG without decoding the pixels.
+
+    Parameters
+    ----------
+    resource_path : `lsst.resources.ResourcePath`
+        Location of the PNG file.
+
+    Returns
+    -------
+    metadata : `dict`
+        The ``has_metadata``, ``label``, ``boxes``, ``width`` and
+        ``height`` of the image.
+    """
+    # Image.open() stops parsing at the first image data chunk,
+    # so only the header and text chunks are read from the file.
+    with resource_path.open("rb") as f:
+        image = Image.open(f)
+        width, height = image.size
+        info = dict(image.info)
+
+    return {
+        'has_metadata': 'boxes' in info,
+        'label': info.get('label'),
+        'boxes': info.get('boxes'),
+        'width': width,
+        'height': height}
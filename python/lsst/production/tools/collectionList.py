@@ -0,0 +1,183 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+
+from .cache import list_cache_files, read_manifest
+
+
+def shorten_repo(repo_name):
+    """
+    Return the repo name without any '/repo/' prefix
+    """
+    return repo_name.split("/")[-1]
+
+
+def list_repo_collections(s3_client, repo):
+    """List the collections with a plot cache file in one repo.
+
+    Parameters
+    ----------
+    s3_client : `botocore.client.S3`
+        Client for the plot navigator bucket.
+    repo : `str`
+        Butler repository name.
+
+    Returns
+    -------
+    entries : `list` of `dict`
+        One entry per collection, with the collection name, the
+        time it was last updated, the short repo name and the url
+        encoded collection name.
+    """
+    entries = []
+    for collection, updated in list_cache_files(s3_client, repo):
+        entries.append(
+            {
+                "name": collection,
+                "updated": updated,
+                "repo": shorten_repo(repo),
+                "url": urllib.parse.quote(collection, safe=""),
+            }
+        )
+
+    return entries
+
+
+def manifest_collections(s3_client, repo):
+    """List the collections of one repo from its manifest, falling
+    back to listing the bucket if cache_plots has not written a
+    manifest for the repo yet.
+
+    Parameters
+    ----------
+    s3_client : `botocore.client.S3`
+        Client for the plot navigator bucket.
+    repo : `str`
+        Butler repository name.
+
+    Returns
+    -------
+    entries : `list` of `dict`
+        As for `list_repo_collections`, with the plot counts and
+        compressed size of the cache file added when they are known.
+    """
+    manifest, _ = read_manifest(s3_client, repo)
+    if manifest is None:
+        return list_repo_collections(s3_client, repo)
+
+    entries = []
+    for collection, manifest_entry in manifest.items():
+        entry = {
+            "name": collection,
+            "updated": datetime.fromisoformat(manifest_entry["updated"]),
+            "repo": shorten_repo(repo),
+            "url": urllib.parse.quote(collection, safe=""),
+        }
+        # Entries seeded from the bucket listing have no counts until
+        # their collection is cached again.
+        if "plot_counts" in manifest_entry:
+            entry["n_plots"] = sum(manifest_entry["plot_counts"].values())
+            entry["plot_counts"] = manifest_entry["plot_counts"]
+            entry["compressed_size"] = manifest_entry["compressed_size"]
+        entries.append(entry)
+
+    return entries
+
+
+class CollectionListing:
+    """The collections with plot cache files in every repo, kept
+    up to date by a background thread.
+
+    Readers always get the most recent listing immediately, and never
+    wait on S3; before the first refresh completes they get nothing.
+
+    Parameters
+    ----------
+    repo_names : `list` of `str`
+        Butler repositories to list collections for.
+    ttl : `float`
+        Seconds between refreshes of the listing.
+    """
+
+    def __init__(self, repo_names, ttl=60):
+        self.repo_names = repo_names
+        self.ttl = ttl
+        self.updated = None
+        self._entries = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def entries(self):
+        """Return the latest listing, starting the refresh thread
+        the first time this is called in a process.
+
+        Returns
+        -------
+        entries : `list` of `dict`
+            Collection entries, or None if the first listing has
+            not finished yet.
+        """
+        with self._lock:
+            if self._thread is None:
+                # Started lazily, so that each forked worker gets its own.
+                self._thread = threading.Thread(
+                    target=self._refresh_loop, name="collection-listing", daemon=True
+                )
+                self._thread.start()
+            if self.updated is None:
+                return None
+            return self._entries
+
+    def refresh(self):
+        """Read every repo's manifest in parallel and replace the
+        cached listing.
+        """
+        session = boto3.Session(profile_name="rubin-plot-navigator")
+        s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+
+        with ThreadPoolExecutor(max_workers=max(len(self.repo_names), 1)) as executor:
+            results = executor.map(
+                lambda repo: manifest_collections(s3_client, repo), self.repo_names
+            )
+            entries = [entry for repo_entries in results for entry in repo_entries]
+
+        entries.sort(key=lambda x: x["updated"], reverse=True)
+        with self._lock:
+            self._entries = entries
+            self.updated = time.time()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep the last listing and try again next time, rather
+                # than letting the thread die.
+                print(f"Could not refresh the collection listing: {e}")
+            time.sleep(self.ttl)
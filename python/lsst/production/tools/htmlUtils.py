@@ -20,8 +20,16 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import hashlib
+import json
+import warnings
+
 import numpy as np
 
+from .cacheUtils import LRUCache
+from .tableLayouts import layout_metric_patterns
+from .tableSchema import get_schema_index
+
 
 class cell_entry:
 
@@ -140,8 +148,8 @@ def make_table_headers(t, table_headers):
 
     Parameters
     ----------
-    t : `astropy.table.Table`
-        Table of metrics
+    t : `astropy.table.Table` or `list` of `str`
+        Table of metrics, or its column names
     table_headers : `list`
         A list of the column headers
 
@@ -151,18 +159,14 @@ def make_table_headers(t, table_headers):
         A dictionary of the headers and what pages they should link to
     bands : `list`
         The bands that the metrics cover
-    """
 
-    col_first = []
-    bands = []
-    for col in t.columns:
-        col_sections = col.split("_")
-        for section in col_sections:
-            if len(section) == 1:
-                bands.append(section)
-            col_first.append(col.split("_")[0])
-
-    bands = list(set(bands))
+    Notes
+    -----
+    The bands come from the parsed schema, which is cached, so
+    the column names are only split up once for each schema.
+    """
+    columns = t.colnames if hasattr(t, "colnames") else t
+    bands = get_schema_index(columns).bands
 
     header_list = []
     link_list = []
@@ -566,7 +570,130 @@ def make_mask_cols(row, metric_defs, cols, prefix):
     return full_cell
 
 
-def worst(t, metric_list, id_col):
+def robust_scores(t, metric_list):
+    """Score how far every value of the given metrics is from
+    the median of its column.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The table of metrics
+    metric_list : `list`
+        The metric columns to score
+
+    Returns
+    -------
+    scores : `numpy.ndarray`
+        The distance of each value from its column median in
+        units of the column sigmaMAD, with a row for each metric.
+        Missing values score -inf so they are never picked.
+    dist : `numpy.ndarray`
+        The raw distance of each value from its column median, to
+        order values with equal scores; every value off the median
+        of a column with a sigmaMAD of zero scores inf.
+    """
+    values = np.empty((len(metric_list), len(t)))
+    for n, metric in enumerate(metric_list):
+        values[n] = column_array(t[metric])
+
+    with warnings.catch_warnings():
+        # All NaN columns just give NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        med = np.nanmedian(values, axis=1, keepdims=True)
+        dist = np.fabs(values - med)
+        sigma_mad = 1.4826 * np.nanmedian(dist, axis=1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.where(sigma_mad > 0, dist / sigma_mad, np.where(dist > 0, np.inf, 0.0))
+    scores[np.isnan(dist) | np.isnan(scores)] = -np.inf
+    return scores, dist
+
+
+def top_k(scores, k, tiebreak=None):
+    """Return the indices of the k highest scores along the last axis,
+    highest first, skipping any that are -inf.
+
+    Equal scores are ordered by the highest ``tiebreak`` value if it
+    is given, and by position otherwise.
+    """
+    k = min(k, scores.shape[-1])
+    if k == 0:
+        return [[] for _ in range(scores.shape[0])] if scores.ndim == 2 else []
+    if tiebreak is not None:
+        if scores.ndim == 2:
+            return [top_k(row_scores, k, row_tiebreak)
+                    for row_scores, row_tiebreak in zip(scores, tiebreak)]
+        # Every score tied with the k-th highest is a candidate, so
+        # the tiebreak decides which of them are kept.
+        kth = np.partition(scores, scores.size - k)[scores.size - k]
+        candidates = np.flatnonzero(scores >= kth)
+        order = np.lexsort((-tiebreak[candidates], -scores[candidates]))[:k]
+        return [n for n in candidates[order].tolist() if scores[n] > -np.inf]
+    top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1, kind="stable")
+    top = np.take_along_axis(top, order, axis=-1)
+    if scores.ndim == 1:
+        return [n for n in top.tolist() if scores[n] > -np.inf]
+    return [[n for n in row if row_scores[n] > -np.inf] for row, row_scores in zip(top.tolist(), scores)]
+
+
+def rank_worst(t, metric_list, id_col, k=5, n_ranked=None):
+    """Find the k worst rows in a table for each of the given
+    metrics, and the k worst rows over all of them.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The table to choose the rows from
+    metric_list : `list`
+        The list of metrics to judge from
+    id_col : `string`
+        The name of the datatype id column
+        e.g. tract or visit number
+    k : `int`
+        The number of rows to pick for each metric
+    n_ranked : `int`, optional
+        The number of rows to rank overall; k if not given.
+
+    Returns
+    -------
+    worst : `list`
+        Tuples of the metric name, a string of the metric value,
+        the tract/visit number and how many sigmaMAD the value is
+        from the median, k for each metric, worst first.
+    ranking : `list`
+        Tuples of the tract/visit number, its worst score and the
+        metric that score is for, for the worst rows overall.
+    rows : `list`
+        The indices in ``t`` of the rows in ``ranking``.
+
+    Notes
+    -----
+    Every metric is scored in one pass, and the worst rows are found
+    with a partial sort, so this scales to every thresholded column
+    of a large visit level table.
+    """
+    if len(metric_list) == 0 or len(t) == 0:
+        return [], [], []
+
+    scores, dist = robust_scores(t, metric_list)
+    ids = t[id_col]
+
+    worst = []
+    for metric, metric_scores, rows in zip(metric_list, scores, top_k(scores, k, dist)):
+        for n in rows:
+            worst.append((metric, f"{t[metric][n]:.3g}", ids[n], float(metric_scores[n])))
+
+    row_scores = scores.max(axis=0)
+    worst_metric = scores.argmax(axis=0)
+    row_dist = np.take_along_axis(dist, worst_metric[None, :], axis=0)[0]
+    rows = top_k(row_scores, k if n_ranked is None else n_ranked, row_dist)
+    ranking = [(ids[n], float(row_scores[n]), metric_list[worst_metric[n]]) for n in rows]
+
+    return worst, ranking, rows
+
+
+def worst(t, metric_list, id_col, k=1):
     """Select the worst rows in a table for the 
     given metrics.
 
@@ -579,6 +706,8 @@ def worst(t, metric_list, id_col):
     id_col : `string`
         The name of the datatype id column
         e.g. tract or visit number
+    k : `int`
+        The number of rows to pick for each metric
 
     Returns
     -------
@@ -590,15 +719,14 @@ def worst(t, metric_list, id_col):
         The shortened table corresponding to the
         bad rows from the original
     """
-
     worst = []
     bad_ids = []
-    for metric in metric_list:
-        med = np.nanmedian(t[metric])
-        dist_med = np.fabs(med - t[metric])
-        bad_id = np.nanargmax(dist_med)
-        bad_ids.append(bad_id)
-        worst.append((metric, f"{t[metric][bad_id]:.3g}", t[id_col][bad_id]))
+    if len(metric_list) > 0 and len(t) > 0:
+        scores, dist = robust_scores(t, metric_list)
+        for metric, rows in zip(metric_list, top_k(scores, k, dist)):
+            for bad_id in rows:
+                bad_ids.append(bad_id)
+                worst.append((metric, f"{t[metric][bad_id]:.3g}", t[id_col][bad_id]))
 
     bad_table = t[bad_ids]
 
@@ -690,9 +818,11 @@ def make_var1_band_var2_cols(row, metric_defs, bands, cols):
 
 
 
-def make_table_cells(t, col_dict, bands, metric_defs, prefix):
+def make_table_cells_per_row(t, col_dict, bands, metric_defs, prefix):
     """
-    Make the cells for the HTML tables
+    Make the cells for the HTML tables one row at a time.
+
+    This is the reference implementation of `make_table_cells`.
 
     Parameters
     ----------
@@ -802,3 +932,773 @@ def make_table_cells(t, col_dict, bands, metric_defs, prefix):
         content_dict[str(id_val)] = row_list
 
     return content_dict
+
+
+class column_entry:
+    """The values of one metric (and its sigma) for every row
+    of a table; the columnar version of `cell_entry`.
+    """
+
+    def __init__(self, n_rows):
+        self.present = False
+        self.num_bad = np.zeros(n_rows, dtype=int)
+        self.link = "noInfo"
+        self.debug_group = None
+        # Either a `text_column` or one string for all rows
+        self.val_strs = "None"
+        self.sig_strs = "None"
+
+
+class text_column:
+    """Strings for the rows of a table column, only made for
+    the rows that are asked for.
+
+    Parameters
+    ----------
+    values : `numpy.ndarray` or `astropy.table.Column`
+        The column values.
+    to_str : callable
+        Turns a list of values into a list of strings.
+    """
+
+    def __init__(self, values, to_str):
+        self.values = values
+        self.to_str = to_str
+
+    def strs(self, rows=None):
+        values = self.values if rows is None else self.values[rows]
+        return self.to_str(values)
+
+
+class formatted_column(text_column):
+    """Formatted metric values for the rows of a table, wrapping
+    NaN and out of threshold values in the given templates.
+    """
+
+    def __init__(self, values, nan_template, bad_template, nan_mask, bad_mask):
+        self.values = values
+        self.nan_template = nan_template
+        self.bad_template = bad_template
+        self.nan_mask = nan_mask
+        self.bad_mask = bad_mask
+
+    def strs(self, rows=None):
+        if rows is None:
+            return format_column(self.values, self.nan_template, self.bad_template,
+                                 self.nan_mask, self.bad_mask)
+        return format_column(self.values[rows], self.nan_template, self.bad_template,
+                             self.nan_mask[rows], self.bad_mask[rows])
+
+
+class column_contents:
+    """One column of cells for every row of a table; the
+    columnar version of `cell_contents`.
+
+    The text of each cell is built up from parts, each either a
+    `text_column` or one string for all rows. The failure counts
+    are known up front, but the text is only made when `texts`
+    is called, and then only for the rows asked for.
+    """
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.num_fails = np.zeros(n_rows, dtype=int)
+        self.parts = []
+        self.link = "noInfo"
+        self.debug_group = None
+
+    def add(self, *parts):
+        self.parts.extend(parts)
+
+    def texts(self, rows=None):
+        """Return the text of the cells of the given rows, or of
+        every row if rows is None.
+        """
+        n_rows = self.n_rows if rows is None else len(rows)
+        if all(isinstance(part, str) for part in self.parts):
+            return ["".join(self.parts)] * n_rows
+        columns = [[part] * n_rows if isinstance(part, str) else part.strs(rows)
+                   for part in self.parts]
+        return ["".join(row_parts) for row_parts in zip(*columns)]
+
+
+def column_array(col):
+    """Return a table column as a plain array, with any masked
+    values replaced by NaN.
+    """
+    if hasattr(col, "mask") and np.any(col.mask):
+        return col.filled(np.nan)
+    return np.asarray(col)
+
+
+def format_column(values, nan_template, bad_template, nan_mask, bad_mask):
+    """Format every value of a metric column, wrapping NaN and
+    out of threshold values in the given templates.
+    """
+    strs = [f"{val:.3g}" for val in values.tolist()]
+    for n in np.flatnonzero(nan_mask):
+        strs[n] = nan_template.format(strs[n])
+    for n in np.flatnonzero(bad_mask):
+        strs[n] = bad_template.format(strs[n])
+    return strs
+
+
+class metric_plan:
+    """The metric columns of a table layout, looked up in the
+    table schema and the metric definitions once.
+
+    Attributes
+    ----------
+    schema : `SchemaIndex`
+        The parsed column names of the table.
+    names : `list` of `str`
+        The metric columns of the layout that are in the table.
+    index : `dict`
+        Position of each metric column in ``names``.
+    low, high : `numpy.ndarray`
+        The thresholds of each metric column; -inf and inf for
+        columns without thresholds.
+    debug_groups : `list`
+        The debug group of each metric column, or None.
+    """
+
+    def __init__(self, colnames, col_dict, metric_defs, prefix):
+        schema = get_schema_index(colnames)
+        self.schema = schema
+        self.names = schema.resolve(layout_metric_patterns(col_dict, prefix))
+        self.index = {name: n for n, name in enumerate(self.names)}
+        self.low = np.full(len(self.names), -np.inf)
+        self.high = np.full(len(self.names), np.inf)
+        self.debug_groups = [None] * len(self.names)
+        for n, name in enumerate(self.names):
+            if name in metric_defs:
+                self.low[n] = metric_defs[name]["lowThreshold"]
+                self.high[n] = metric_defs[name]["highThreshold"]
+                self.debug_groups[n] = metric_defs[name]["debugGroup"]
+
+
+# Compiled plans keyed by a hash of the table schema, the layout
+# and the metric definitions they were made from.
+metric_plans = LRUCache(maxsize=64)
+
+
+def metric_defs_key(metric_defs):
+    """Identify a version of the metric definitions."""
+    etag = getattr(metric_defs, "etag", None)
+    if etag is not None:
+        return etag
+    return hashlib.sha1(json.dumps(metric_defs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_metric_plan(colnames, col_dict, metric_defs, prefix):
+    """Return the compiled `metric_plan` for a table schema and layout,
+    making it only if it has not been made before.
+
+    Parameters
+    ----------
+    colnames : `list` of `str`
+        The column names of the table.
+    col_dict : `dict`
+        A dict of the columns
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    prefix : `string`
+        The prefix that goes at the start of the colunm name
+
+    Returns
+    -------
+    plan : `metric_plan`
+    """
+    layout_hash = hashlib.sha1(json.dumps([col_dict, prefix], sort_keys=True).encode()).hexdigest()
+    key = (get_schema_index(colnames).fingerprint, layout_hash, metric_defs_key(metric_defs))
+    plan = metric_plans.get(key)
+    if plan is None:
+        plan = metric_plan(colnames, col_dict, metric_defs, prefix)
+        metric_plans.put(key, plan)
+    return plan
+
+
+class table_metrics:
+    """The metric columns of a table checked against a `metric_plan`.
+
+    All the thresholds are evaluated in one go, giving ``nan`` and
+    ``bad`` masks with a row for each metric column in the plan.
+    """
+
+    def __init__(self, t, plan):
+        self.t = t
+        self.plan = plan
+        self.n_rows = len(t)
+        values = np.empty((len(plan.names), len(t)))
+        for n, name in enumerate(plan.names):
+            values[n] = column_array(t[name])
+        self.nan = np.isnan(values)
+        with np.errstate(invalid="ignore"):
+            self.bad = (values < plan.low[:, None]) | (values > plan.high[:, None])
+
+
+def make_column_values(metrics, val_col_name, sig_col_name):
+    """Turn the values from the given columns into formatted
+    cell contents for every row of the table at once.
+
+    Parameters
+    ----------
+    metrics : `table_metrics`
+        The checked metric columns of the table
+    val_col_name : `str` or None
+        The name of the metric column, None if the table lacks it
+    sig_col_name : `str` or None
+        The associated sigma column, None if the table lacks it
+
+    Returns
+    -------
+    entry : `column_entry`
+        The same information as `make_table_value` returns,
+        with per row values for val_strs, sig_strs and num_bad.
+    """
+    plan = metrics.plan
+    entry = column_entry(metrics.n_rows)
+    val_n = plan.index.get(val_col_name)
+    sig_n = plan.index.get(sig_col_name)
+    if val_n is None and sig_n is None:
+        return entry
+
+    entry.present = True
+    entry.link = "metrics.report_page"
+
+    entry.val_strs = ""
+    if val_n is not None:
+        entry.debug_group = plan.debug_groups[val_n]
+        entry.num_bad += metrics.bad[val_n]
+        entry.val_strs = formatted_column(
+            column_array(metrics.t[val_col_name]),
+            "<FONT CLASS=nanValue>{} </FONT>", "<FONT CLASS=badValue>{}</FONT>",
+            metrics.nan[val_n], metrics.bad[val_n]
+        )
+
+    entry.sig_strs = ""
+    if sig_n is not None:
+        entry.num_bad += metrics.bad[sig_n]
+        entry.sig_strs = formatted_column(
+            column_array(metrics.t[sig_col_name]),
+            "<FONT CLASS=nanValue>{}</FONT>\n", "<FONT CLASS=badValue>{}</FONT>\n",
+            metrics.nan[sig_n], metrics.bad[sig_n]
+        )
+
+    return entry
+
+
+def make_general_column(t, col):
+    column = column_contents(len(t))
+    column.add(text_column(t[col], lambda values: [str(val) for val in values]))
+    return column
+
+
+def make_patch_num_column(t, bands):
+    column = column_contents(len(t))
+    schema = get_schema_index(t.colnames)
+    for band in ["u", "g", "r", "i", "z", "y"]:
+        if band in bands:
+            patch_col = schema.column("coaddPatchCount", band, "patchCount")
+            if patch_col is None:
+                column.add("<B>" + band + "</B>: - <BR>\n")
+            else:
+                column.add("<B>" + band + "</B>: ",
+                           text_column(np.asarray(t[patch_col]),
+                                       lambda values: [str(int(val)) for val in values.tolist()]),
+                           "<BR>\n")
+    return column
+
+
+def make_num_inputs_column(metrics, bands):
+    column = column_contents(metrics.n_rows)
+    schema = metrics.plan.schema
+    for band in ["u", "g", "r", "i", "z", "y"]:
+        if band in bands:
+            val_col_name = schema.column("coaddInputCount", band, "inputCount_median")
+            sig_col_name = schema.column("coaddInputCount", band, "inputCount_sigmaMad")
+            entry = make_column_values(metrics, val_col_name, sig_col_name)
+            column.add(f"<B>{band}</B>: ", entry.val_strs, " <B>&sigma;</B> ",
+                       entry.sig_strs, "<BR>\n")
+            if entry.debug_group is not None:
+                column.debug_group = entry.debug_group
+    return column
+
+
+def make_shape_columns(metrics, bands, cols):
+    columns = []
+    schema = metrics.plan.schema
+    for col in cols:
+        for sn in ["highSNStars", "lowSNStars"]:
+            column = column_contents(metrics.n_rows)
+            for band in ["u", "g", "r", "i", "z", "y"]:
+                if band in bands:
+                    val_col_name = schema.column(col, band, sn + "_median")
+                    sig_col_name = schema.column(col, band, sn + "_sigmaMad")
+                    entry = make_column_values(metrics, val_col_name, sig_col_name)
+                    column.num_fails += entry.num_bad
+                    column.add(f"<B>{band}</B>: ", entry.val_strs, " <B>&sigma;</B>: ",
+                               entry.sig_strs, "<BR>\n")
+                    if entry.debug_group is not None:
+                        column.debug_group = entry.debug_group
+                    column.link = entry.link
+            columns.append(column)
+    return columns
+
+
+def make_stellar_locus_columns(metrics, cols):
+    columns = []
+    for col in cols:
+        # Only the last flux type makes it into the cell, as in
+        # make_stellar_locus_cols.
+        flux, flux1 = "cModelFlux", "CModel"
+        column = column_contents(metrics.n_rows)
+        val_col_name = col + flux1 + "_" + col + "_" + flux + "_median"
+        sig_col_name = col + flux1 + "_" + col + "_" + flux + "_sigmaMAD"
+        entry = make_column_values(metrics, val_col_name, sig_col_name)
+        if entry.present:
+            column.add(f"<B>{flux}</B><BR><B>Med</B>: ", entry.val_strs,
+                       "  <B>&sigma;</B>: ", entry.sig_strs, "<BR><BR>\n")
+            column.num_fails += entry.num_bad
+            if entry.debug_group is not None:
+                column.debug_group = entry.debug_group
+            column.link = entry.link
+        columns.append(column)
+    return columns
+
+
+def make_photom_columns(metrics, bands, cols):
+    columns = []
+    schema = metrics.plan.schema
+    for col in cols:
+        column = column_contents(metrics.n_rows)
+        for band in ["u", "g", "r", "i", "z", "y"]:
+            if band in bands:
+                for part in ["psf_cModel_diff"]:
+                    val_col_name = schema.column(col, band, part + "_median")
+                    sig_col_name = schema.column(col, band, part + "_sigmaMad")
+                    entry = make_column_values(metrics, val_col_name, sig_col_name)
+                    column.add(f"<B>{band}</B>: ", entry.val_strs, "  <B>&sigma;</B>: ",
+                               entry.sig_strs, "<BR>\n")
+                    column.num_fails += entry.num_bad
+                    column.debug_group = entry.debug_group
+                    column.link = entry.link
+        columns.append(column)
+    return columns
+
+
+def make_sky_columns(metrics, bands, cols):
+    columns = []
+    schema = metrics.plan.schema
+    for col in cols:
+        for stat, dev in [("mean", "stdev"), ("median", "sigmaMAD")]:
+            column = column_contents(metrics.n_rows)
+            for band in ["u", "g", "r", "i", "z", "y"]:
+                if band in bands:
+                    val_col_name = schema.column(col, band, stat + "Sky")
+                    sig_col_name = schema.column(col, band, dev + "Sky")
+                    entry = make_column_values(metrics, val_col_name, sig_col_name)
+                    column.add(f"<B>{band}</B>: ", entry.val_strs, " <B>&sigma;</B>: ",
+                               entry.sig_strs, "<BR>\n")
+                    column.num_fails += entry.num_bad
+            columns.append(column)
+    return columns
+
+
+def make_footprint_column(metrics, cols, prefix):
+    column = column_contents(metrics.n_rows)
+    for col in cols:
+        val_col_name = prefix + "_" + col + "_footprint_count"
+        entry = make_column_values(metrics, val_col_name, None)
+        column.add(f"<B>{col}</B>: ", entry.val_strs, " <BR>")
+        column.num_fails += entry.num_bad
+    return column
+
+
+def make_source_column(metrics, cols, prefix):
+    column = column_contents(metrics.n_rows)
+    for col in cols:
+        val_col_name = prefix + "_" + col + "_source_count"
+        if col == "":
+            val_col_name = prefix + "_source_count"
+            col = "sources"
+        entry = make_column_values(metrics, val_col_name, None)
+        column.add(f"<B>{col}</B>: ", entry.val_strs, "<BR>")
+        column.num_fails += entry.num_bad
+    return column
+
+
+def make_mask_column(metrics, cols, prefix):
+    column = column_contents(metrics.n_rows)
+    for col in cols:
+        val_col_name = prefix + "_" + col + "_mask_fraction"
+        entry = make_column_values(metrics, val_col_name, None)
+        column.add(f"<B>{col}</B>: ", entry.val_strs, "<BR>")
+        column.num_fails += entry.num_bad
+    return column
+
+
+def make_stellar_ast_self_rep_columns(metrics, bands, cols):
+    columns = []
+    schema = metrics.plan.schema
+    prefix = "stellarAstrometricSelfRepeatability"
+    for col in cols:
+        column = column_contents(metrics.n_rows)
+        column.add(f"<B>{col}</B><BR>")
+        for band in ["u", "g", "r", "i", "z", "y"]:
+            column.add(f"<B>{band}</B>: ")
+            if band in bands:
+                for coord in ["RA", "Dec"]:
+                    val_col_name = schema.column(prefix + coord, band, col + "_" + coord)
+                    entry = make_column_values(metrics, val_col_name, None)
+                    column.num_fails += entry.num_bad
+                    column.add(f"<B>{coord}:</B>", entry.val_strs, " ")
+                    if entry.debug_group is not None:
+                        column.debug_group = entry.debug_group
+                    column.link = entry.link
+            column.add("<BR>")
+        columns.append(column)
+    return columns
+
+
+def make_var1_band_var2_columns(metrics, bands, cols):
+    columns = []
+    schema = metrics.plan.schema
+    for (var1, var2) in cols:
+        column = column_contents(metrics.n_rows)
+        for band in ["u", "g", "r", "i", "z", "y"]:
+            column.add(f"<B>{band}</B>: ")
+            if band in bands:
+                val_col_name = schema.column(var1, band, var2)
+                entry = make_column_values(metrics, val_col_name, None)
+                column.num_fails += entry.num_bad
+                column.add("</B>", entry.val_strs, " ")
+                if entry.debug_group is not None:
+                    column.debug_group = entry.debug_group
+                column.link = entry.link
+            column.add("<BR>")
+        columns.append(column)
+    return columns
+
+
+def make_table_columns(t, col_dict, bands, metric_defs, prefix):
+    """
+    Evaluate every cell of the HTML table a column at a time.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The table to make the table from
+    col_dict : `dict`
+        A dict of the columns
+    bands : `list`
+        A list of the bands
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    prefix : `string`
+        The prefix that goes at the start of the colunm name
+
+    Returns
+    -------
+    table_columns : `list` of `column_contents`
+        The general columns, in table order.
+    metric_columns : `list` of `column_contents`
+        The metric columns, in table order.
+    num_bad : `numpy.ndarray`
+        The number of failed metrics in each row.
+    """
+    plan = get_metric_plan(t.colnames, col_dict, metric_defs, prefix)
+    metrics = table_metrics(t, plan)
+
+    table_columns = []
+    for col in col_dict["table_cols"]:
+        if col == "failed metrics":
+            continue
+        elif col == "nPatches":
+            table_columns.append(make_patch_num_column(t, bands))
+        elif col == "nInputs":
+            table_columns.append(make_num_inputs_column(metrics, bands))
+        else:
+            table_columns.append(make_general_column(t, col))
+
+    metric_columns = []
+    if "footprint_cols" in col_dict.keys():
+        metric_columns.append(make_footprint_column(metrics, col_dict["footprint_cols"], prefix))
+    if "source_cols" in col_dict.keys():
+        metric_columns.append(make_source_column(metrics, col_dict["source_cols"], prefix))
+    if "mask_cols" in col_dict.keys():
+        metric_columns.append(make_mask_column(metrics, col_dict["mask_cols"], prefix))
+    if "shape_cols" in col_dict.keys():
+        metric_columns += make_shape_columns(metrics, bands, col_dict["shape_cols"])
+    if "stellar_locus_cols" in col_dict.keys():
+        metric_columns += make_stellar_locus_columns(metrics, col_dict["stellar_locus_cols"])
+    if "photom_cols" in col_dict.keys():
+        metric_columns += make_photom_columns(metrics, bands, col_dict["photom_cols"])
+    if "sky_cols" in col_dict.keys():
+        metric_columns += make_sky_columns(metrics, bands, col_dict["sky_cols"])
+    if "sasr_cols" in col_dict.keys():
+        metric_columns += make_stellar_ast_self_rep_columns(metrics, bands, col_dict["sasr_cols"])
+    if "var1_band_var2" in col_dict.keys():
+        metric_columns += make_var1_band_var2_columns(metrics, bands, col_dict["var1_band_var2"])
+
+    num_bad = np.zeros(len(t), dtype=int)
+    for column in metric_columns:
+        num_bad += column.num_fails
+
+    return table_columns, metric_columns, num_bad
+
+
+# The pages cells can link to, indexed by cell_store.link_index
+CELL_LINKS = ["noInfo", "metrics.report_page"]
+
+
+class cell_store:
+    """The cells of a metrics table held as parallel arrays, with
+    the text of each cell only made when it is read.
+
+    Parameters
+    ----------
+    ids : `astropy.table.Column`
+        The id column of the table
+    table_columns : `list` of `column_contents`
+        The general columns, from `make_table_columns`
+    metric_columns : `list` of `column_contents`
+        The metric columns, from `make_table_columns`
+    num_bad : `numpy.ndarray`
+        The number of failed metrics in each row
+
+    Attributes
+    ----------
+    num_fails : `numpy.ndarray`
+        The failure count of each cell, rows x cells.
+    num_bad : `numpy.ndarray`
+        The number of failed metrics in each row.
+    link_index : `numpy.ndarray`
+        The index in `CELL_LINKS` of the link of each column of cells.
+    debug_index : `numpy.ndarray`
+        The index in ``debug_groups`` of the debug group of each
+        column of cells, or -1 for none.
+    debug_groups : `list` of `str`
+
+    Notes
+    -----
+    Cell 0 of each row is the id cell, which links to the single
+    tract page, as from `make_id_val_cell`.
+    """
+
+    def __init__(self, ids, table_columns, metric_columns, num_bad):
+        self.ids = ids
+        self.num_bad = num_bad
+
+        failed = column_contents(len(ids))
+        failed.add(text_column(num_bad, lambda values: [str(val) for val in values.tolist()]))
+        id_cell = column_contents(len(ids))
+        id_cell.add("metrics.single_tract")
+        self.columns = [id_cell] + table_columns + [failed] + metric_columns
+
+        self.num_fails = np.zeros((len(ids), len(self.columns)), dtype=np.int32)
+        first_metric = len(table_columns) + 2
+        for n, column in enumerate(metric_columns):
+            self.num_fails[:, first_metric + n] = column.num_fails
+
+        self.link_index = np.array([CELL_LINKS.index(column.link) for column in self.columns], dtype=np.int8)
+        self.debug_groups = sorted(set(column.debug_group for column in self.columns
+                                       if column.debug_group is not None))
+        self.debug_index = np.array([-1 if column.debug_group is None
+                                     else self.debug_groups.index(column.debug_group)
+                                     for column in self.columns], dtype=np.int16)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """The memory used by the arrays the cells are made from,
+        including any table columns they share with the table.
+        """
+        nbytes = self.num_fails.nbytes + getattr(self.num_bad, "nbytes", 0) + getattr(self.ids, "nbytes", 0)
+        for column in self.columns:
+            for part in column.parts:
+                if isinstance(part, text_column):
+                    nbytes += sum(getattr(getattr(part, name, None), "nbytes", 0)
+                                  for name in ("values", "nan_mask", "bad_mask"))
+        return nbytes
+
+    def link(self, cell):
+        return CELL_LINKS[self.link_index[cell]]
+
+    def debug_group(self, cell):
+        index = self.debug_index[cell]
+        return None if index < 0 else self.debug_groups[index]
+
+    def iter_rows(self, rows=None, chunk_size=1000):
+        """Yield rows of the table, formatting the text of a chunk
+        of rows at a time.
+
+        Parameters
+        ----------
+        rows : `list` of `int`, optional
+            The rows to make, in order; all of them if None.
+        chunk_size : `int`
+            The number of rows to format at once.
+
+        Yields
+        ------
+        id_val, row
+            The id value and a `store_row` for each row.
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+        rows = np.asarray(rows, dtype=int)
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            texts = [column.texts(chunk) for column in self.columns]
+            for n, (row, id_val) in enumerate(zip(chunk.tolist(), self.ids[chunk])):
+                yield id_val, store_row(self, row, texts, n)
+
+
+class store_row:
+    """A row of a `cell_store`, which behaves like a list of
+    `cell_contents` without making an object for every cell
+    until it is read.
+    """
+
+    __slots__ = ("store", "row", "texts", "n")
+
+    def __init__(self, store, row, texts, n):
+        self.store = store
+        self.row = row
+        self.texts = texts
+        self.n = n
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[cell] for cell in range(len(self))[index]]
+        return store_cell(self, index)
+
+    def __iter__(self):
+        return (store_cell(self, cell) for cell in range(len(self)))
+
+
+class store_cell:
+    """A cell of a `store_row`, with the same attributes as
+    `cell_contents`.
+    """
+
+    __slots__ = ("_row", "_cell")
+
+    def __init__(self, row, cell):
+        self._row = row
+        self._cell = cell
+
+    @property
+    def text(self):
+        return self._row.texts[self._cell][self._row.n]
+
+    @property
+    def num_fails(self):
+        return int(self._row.store.num_fails[self._row.row, self._cell])
+
+    @property
+    def link(self):
+        return self._row.store.link(self._cell)
+
+    @property
+    def debug_group(self):
+        return self._row.store.debug_group(self._cell)
+
+    def to_contents(self):
+        cell = cell_contents()
+        cell.text = self.text
+        cell.num_fails = self.num_fails
+        cell.link = self.link
+        cell.debug_group = self.debug_group
+        return cell
+
+
+def make_table_store(t, col_dict, bands, metric_defs, prefix):
+    """
+    Make the `cell_store` for the HTML tables
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The table to make the table from
+    col_dict : `dict`
+        A dict of the columns
+    bands : `list`
+        A list of the bands
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    prefix : `string`
+        The prefix that goes at the start of the colunm name
+
+    Returns
+    -------
+    store : `cell_store`
+    """
+    table_columns, metric_columns, num_bad = make_table_columns(
+        t, col_dict, bands, metric_defs, prefix
+    )
+    return cell_store(t[col_dict["id_col"]], table_columns, metric_columns, num_bad)
+
+
+def make_table_rows(store, rows=None):
+    """
+    Make rows of `cell_contents` from a `cell_store`.
+
+    Parameters
+    ----------
+    store : `cell_store`
+        The cells of the table
+    rows : `list` of `int`, optional
+        The rows to make, in order; all of them if None. Only
+        the text of these rows is formatted.
+
+    Returns
+    -------
+    table_rows : `list`
+        Tuples of the id value and a list of `cell_contents`
+        for each row.
+    """
+    return [(id_val, [cell.to_contents() for cell in row])
+            for id_val, row in store.iter_rows(rows)]
+
+
+def make_table_cells(t, col_dict, bands, metric_defs, prefix):
+    """
+    Make the cells for the HTML tables
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The table to make the table from
+    col_dict : `dict`
+        A dict of the columns
+    bands : `list`
+        A list of the bands
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    prefix : `string`
+        The prefix that goes at the start of the colunm name
+
+    Returns
+    -------
+    content_dict : `dict`
+        A dict of table rows keyed by the id column
+
+    Notes
+    -----
+    The thresholds are evaluated for whole columns at once, which
+    gives the same cells as `make_table_cells_per_row` much faster.
+    """
+    store = make_table_store(t, col_dict, bands, metric_defs, prefix)
+
+    content_dict = {}
+    for id_val, row_list in make_table_rows(store):
+        content_dict[str(id_val)] = row_list
+
+    return content_dict
@@ -20,27 +20,147 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-from flask import Blueprint, send_file, g, request, make_response
+from flask import Blueprint, Response, send_file, g, request, make_response, stream_with_context
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
 import os
 import io
+import tarfile
+import threading
+import time
+import zipfile
 from PIL import Image
 
-from lsst.daf.butler import Butler, DatasetId
+from lsst.daf.butler import DatasetId
 from lsst.resources import ResourcePath
 
+from . import cache
+from .butlerPool import release_request_butler, request_butler
+from .cacheUtils import LRUCache, read_png_metadata
+
 bp = Blueprint("images", __name__, url_prefix="/plot-navigator/images", static_folder="../../../../static")
 
 REPO_NAMES = os.getenv("BUTLER_REPO_NAMES").split(",")
 
-butler_map = {}
+# uuid -> image metadata, keyed by (repo, collection)
+metadata_indexes = LRUCache(maxsize=32, ttl=600)
+
+# Contact sheets keyed by the full set of inputs used to make them.
+contact_sheets = LRUCache(maxsize=16)
+MAX_SHEET_TILES = 400
+# Upper bound on the pixels in one sheet; tiles are shrunk to fit.
+MAX_SHEET_PIXELS = int(os.getenv("MAX_SHEET_PIXELS", str(32 * 1024 * 1024)))
+sheet_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SHEET_THREADS", "8")))
+
+# Transcoded copies of plots keyed by (repo, uuid, format). They are made
+# in the background the first time a plot is requested, and the original
+# PNG is served until the rendition is ready.
+RENDITION_FORMATS = {
+    "webp": ("image/webp", {"format": "WEBP", "lossless": True, "method": 4}),
+    "png": ("image/png", {"format": "PNG", "optimize": True}),
+}
+renditions = LRUCache(
+    maxsize=int(os.getenv("RENDITION_CACHE_SIZE", "256")),
+    maxbytes=int(os.getenv("RENDITION_CACHE_BYTES", str(256 * 1024**2))),
+    sizeof=lambda rendition: len(rendition[0]),
+)
+rendition_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RENDITION_THREADS", "2")))
+# Renditions requested while this many are already queued are dropped;
+# the original PNG keeps being served and a later request retries.
+MAX_PENDING_RENDITIONS = int(os.getenv("MAX_PENDING_RENDITIONS", "64"))
+rendition_lock = threading.Lock()
+pending_renditions = set()
+rendition_stats = {fmt: {"count": 0, "original_bytes": 0, "rendition_bytes": 0}
+                   for fmt in RENDITION_FORMATS}
+
+# Bulk downloads share one pool, and each download keeps at most
+# ARCHIVE_READ_AHEAD plots in memory at a time.
+archive_executor = ThreadPoolExecutor(max_workers=int(os.getenv("ARCHIVE_THREADS", "8")))
+ARCHIVE_READ_AHEAD = int(os.getenv("ARCHIVE_READ_AHEAD", "8"))
 
 def get_butler_map(repo):
 
-    if repo in REPO_NAMES and (repo not in butler_map.keys()):
-        print("Instantiating a butler")
-        butler_map[repo] = Butler(repo)
+    return request_butler(repo)
+
+def get_metadata_index(repo, collection):
+    """Return the uuid -> metadata map stored in the plot cache
+    file of a collection, or None if it was not indexed.
+    """
+
+    index = metadata_indexes.get((repo, collection))
+    if index is None:
+        summary = cache.read_collection_summary(repo, collection)
+        index = {}
+        if summary is not None:
+            for section in summary.values():
+                for ref_dicts in section.values():
+                    for ref_dict in ref_dicts:
+                        if 'has_metadata' in ref_dict:
+                            index[ref_dict['id']] = ref_dict
+        metadata_indexes.put((repo, collection), index)
+
+    return index
+
+def negotiate_format():
+    """Pick the rendition format to serve from the Accept header.
+
+    WebP is only used if the client asks for it by name, since
+    clients sending just */* may not be able to decode it.
+    """
+    accepted = [value for value, quality in request.accept_mimetypes if quality > 0]
+    if "image/webp" in accepted:
+        return "webp"
+    return "png"
+
+def make_rendition(key, image_bytes, has_metadata):
+    """Transcode a PNG and store the result in the rendition cache.
+    """
+    fmt = key[2]
+    try:
+        mimetype, save_kwargs = RENDITION_FORMATS[fmt]
+        image = Image.open(io.BytesIO(image_bytes))
+        out = io.BytesIO()
+        image.save(out, **save_kwargs)
+        rendition = out.getvalue()
+        # Never serve a rendition that is bigger than the original.
+        if len(rendition) >= len(image_bytes):
+            rendition, mimetype = image_bytes, "image/png"
+        renditions.put(key, (rendition, mimetype, has_metadata))
+        with rendition_lock:
+            stats = rendition_stats[fmt]
+            stats["count"] += 1
+            stats["original_bytes"] += len(image_bytes)
+            stats["rendition_bytes"] += len(rendition)
+    except Exception as e:
+        print(f"Could not make {fmt} rendition of {key[1]}: {e}")
+    finally:
+        with rendition_lock:
+            pending_renditions.discard(key)
 
-    return butler_map[repo]
+def request_rendition(key, image_bytes, has_metadata):
+    """Queue a rendition to be made unless one is already queued
+    or the queue is full.
+    """
+    with rendition_lock:
+        if key in pending_renditions or len(pending_renditions) >= MAX_PENDING_RENDITIONS:
+            return
+        pending_renditions.add(key)
+    rendition_executor.submit(make_rendition, key, image_bytes, has_metadata)
+
+@bp.route("/renditions")
+def rendition_summary():
+    """Report the bytes saved by serving transcoded plots.
+    """
+    summary = {}
+    with rendition_lock:
+        for fmt, stats in rendition_stats.items():
+            saved = stats["original_bytes"] - stats["rendition_bytes"]
+            summary[fmt] = dict(stats, saved_bytes=saved,
+                                saved_fraction=(saved / stats["original_bytes"]
+                                                if stats["original_bytes"] else 0.0))
+    return summary
 
 @bp.route("/uuid/<url:repo>/<uuid>", methods=["GET", "HEAD"])
 def index(repo, uuid):
@@ -48,6 +168,18 @@ def index(repo, uuid):
     if repo not in REPO_NAMES:
         return {"error": f"Invalid repo {repo}"}, 400
 
+    # Renditions are only made for plots that have already been
+    # checked, so a cached one can be sent without a registry lookup.
+    rendition_key = (repo, uuid, negotiate_format())
+    rendition = renditions.get(rendition_key)
+    if request.method == "GET" and rendition is not None:
+        rendition_bytes, mimetype, has_metadata = rendition
+        response = send_file(io.BytesIO(rendition_bytes), mimetype=mimetype)
+        response.vary.add("Accept")
+        if has_metadata:
+            response.headers['Has-Metadata'] = 'true'
+        return response
+
     butler = get_butler_map(repo)
     dataset_ref = butler.get_dataset(DatasetId(uuid))
     resource_path = ResourcePath(butler.getURI(dataset_ref))
@@ -55,21 +187,24 @@ def index(repo, uuid):
     if dataset_ref.datasetType.storageClass_name != "Plot":
         return {"error": "Storage class of dataset is not 'Plot'"}, 400
 
-    image_bytes = io.BytesIO(resource_path.read())
-    image = Image.open(image_bytes)
-
-
     if request.method == "HEAD":
         response = make_response()
+        ref_dict = None
+        if request.args.get("collection") is not None:
+            ref_dict = get_metadata_index(repo, request.args["collection"]).get(uuid)
+        if ref_dict is None:
+            ref_dict = read_png_metadata(resource_path)
+        has_metadata = ref_dict['has_metadata']
 
     else:
-        # BytesIO behaves like a stream, so sharing it between
-        # Image.open() and send_file() causes issues.
-        image_to_send = io.BytesIO(resource_path.read())
-        response = send_file(image_to_send, mimetype="image/png")
+        image_bytes = resource_path.read()
+        has_metadata = 'boxes' in Image.open(io.BytesIO(image_bytes)).info
+        response = send_file(io.BytesIO(image_bytes), mimetype="image/png")
+        response.vary.add("Accept")
+        request_rendition(rendition_key, image_bytes, has_metadata)
 
     # PNG metadata used for identifying image regions.
-    if 'boxes' in image.info:
+    if has_metadata:
         response.headers['Has-Metadata'] = 'true'
 
     return response
@@ -80,6 +215,14 @@ def metadata(repo, uuid):
     if repo not in REPO_NAMES:
         return {"error": f"Invalid repo {repo}"}, 400
 
+    # Serve from the metadata index written by cache_plots if the
+    # caller knows which collection the plot came from.
+    collection = request.args.get("collection")
+    if collection is not None:
+        ref_dict = get_metadata_index(repo, collection).get(uuid)
+        if ref_dict is not None:
+            return {'label': ref_dict['label'], 'boxes': ref_dict['boxes']}
+
     butler = get_butler_map(repo)
     dataset_ref = butler.get_dataset(DatasetId(uuid))
     resource_path = ResourcePath(butler.getURI(dataset_ref))
@@ -87,9 +230,270 @@ def metadata(repo, uuid):
     if dataset_ref.datasetType.storageClass_name != "Plot":
         return {"error": "Storage class of dataset is not 'Plot'"}, 400
 
-    image_bytes = io.BytesIO(resource_path.read())
-    image = Image.open(image_bytes)
-    return {
-        'label': image.info['label'] if 'label' in image.info else None,
-        'boxes': image.info['boxes'] if 'boxes' in image.info else None}
+    metadata = read_png_metadata(resource_path)
+    return {'label': metadata['label'], 'boxes': metadata['boxes']}
+
+
+def make_tile(butler, uuid, tile_size):
+    """Read a plot and downscale it to fit in a square tile.
+    """
+    dataset_ref = butler.get_dataset(DatasetId(uuid))
+    if dataset_ref is None:
+        raise ValueError(f"Dataset {uuid} not found")
+    if dataset_ref.datasetType.storageClass_name != "Plot":
+        raise ValueError("Storage class of dataset is not 'Plot'")
+
+    image_bytes = ResourcePath(butler.getURI(dataset_ref)).read()
+    image = Image.open(io.BytesIO(image_bytes))
+    image.thumbnail((tile_size, tile_size))
+    return image.convert("RGB")
+
+def build_contact_sheet(repo, uuids, tile_size, columns):
+    """Composite a list of plots into one image.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository the plots are in.
+    uuids : `tuple` of `str`
+        Dataset ids of the plots, in display order.
+    tile_size : `int`
+        Size in pixels of the square tile each plot is fitted into.
+    columns : `int`
+        Number of tiles per row.
+
+    Returns
+    -------
+    sheet : `bytes`
+        The PNG encoded contact sheet.
+    tile_map : `dict`
+        The position of each plot within the sheet.
+    """
+
+    key = (repo, uuids, tile_size, columns)
+    cached = contact_sheets.get(key)
+    if cached is not None:
+        return cached
+
+    butler = get_butler_map(repo)
+    futures = [sheet_executor.submit(make_tile, butler, uuid, tile_size) for uuid in uuids]
+
+    rows = math.ceil(len(uuids) / columns)
+    sheet = Image.new("RGB", (columns * tile_size, rows * tile_size), "white")
+    tiles = []
+    for n, (uuid, future) in enumerate(zip(uuids, futures)):
+        x = (n % columns) * tile_size
+        y = (n // columns) * tile_size
+        tile = {'uuid': uuid, 'x': x, 'y': y, 'width': 0, 'height': 0}
+        try:
+            image = future.result()
+        except Exception as e:
+            tile['error'] = str(e)
+        else:
+            # Center the plot within its tile.
+            x += (tile_size - image.width) // 2
+            y += (tile_size - image.height) // 2
+            sheet.paste(image, (x, y))
+            tile.update({'x': x, 'y': y, 'width': image.width, 'height': image.height})
+        tiles.append(tile)
+
+    sheet_bytes = io.BytesIO()
+    sheet.save(sheet_bytes, format="PNG")
+    tile_map = {'width': sheet.width, 'height': sheet.height,
+                'tile_size': tile_size, 'columns': columns, 'tiles': tiles}
+
+    contact_sheets.put(key, (sheet_bytes.getvalue(), tile_map))
+    return sheet_bytes.getvalue(), tile_map
+
+def parse_sheet_args(repo):
+    """Validate the query arguments shared by the contact sheet routes.
+
+    Returns the arguments for `build_contact_sheet`, or an
+    error response.
+    """
+
+    if repo not in REPO_NAMES:
+        return None, ({"error": f"Invalid repo {repo}"}, 400)
+
+    uuids = []
+    for value in request.args.getlist("uuid"):
+        uuids.extend(x for x in value.split(",") if x)
+    if len(uuids) == 0:
+        return None, ({"error": "No uuids given"}, 400)
+    if len(uuids) > MAX_SHEET_TILES:
+        return None, ({"error": f"At most {MAX_SHEET_TILES} plots per sheet"}, 400)
+
+    columns = request.args.get("columns", math.ceil(math.sqrt(len(uuids))), type=int)
+    columns = min(max(columns, 1), len(uuids))
+
+    # Shrink the tiles so that the whole canvas, blank cells included,
+    # stays under MAX_SHEET_PIXELS.
+    n_cells = columns * math.ceil(len(uuids) / columns)
+    tile_size = min(max(request.args.get("tile", 256, type=int), 32), 1024)
+    tile_size = max(min(tile_size, math.isqrt(MAX_SHEET_PIXELS // n_cells)), 32)
+
+    return (repo, tuple(uuids), tile_size, columns), None
+
+@bp.route("/sheet/<url:repo>")
+def sheet(repo):
+
+    sheet_args, error = parse_sheet_args(repo)
+    if error is not None:
+        return error
+
+    sheet_bytes, _ = build_contact_sheet(*sheet_args)
+    return send_file(io.BytesIO(sheet_bytes), mimetype="image/png")
+
+@bp.route("/sheet_md/<url:repo>")
+def sheet_metadata(repo):
+
+    sheet_args, error = parse_sheet_args(repo)
+    if error is not None:
+        return error
+
+    _, tile_map = build_contact_sheet(*sheet_args)
+    return tile_map
+
+
+class StreamSink:
+    """A write-only file object whose contents are drained
+    by the response generator after each archive member.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def resolve_plot(butler, uuid):
+    dataset_ref = butler.get_dataset(DatasetId(uuid))
+    if dataset_ref is None:
+        raise ValueError(f"Dataset {uuid} not found")
+    return ResourcePath(butler.getURI(dataset_ref))
+
+def resolve_plots(butler, ref_dicts):
+    """Look up the location of each plot, so that the plots can be
+    read after the Butler has been given back.
+
+    Returns a list of (ref_dict, resource_path, error) tuples.
+    """
+
+    def resolve_one(ref_dict):
+        try:
+            return ref_dict, resolve_plot(butler, ref_dict["id"]), None
+        except Exception as e:
+            return ref_dict, None, str(e)
+
+    return list(archive_executor.map(resolve_one, ref_dicts))
+
+def read_plot(resource_path, error):
+    if error is not None:
+        raise ValueError(error)
+    return resource_path.read()
+
+def archive_member_name(plot_type, ref_dict):
+    """Make a file name for a plot from its dataId.
+    """
+    data_id = json.loads(ref_dict["dataId"])
+    parts = [str(value) for key, value in data_id.items() if key not in ("instrument", "skymap")]
+    return f"{plot_type}/{'_'.join(parts + [ref_dict['id']])}.png"
+
+def generate_archive(plot_type, plots, archive_format):
+    """Yield the bytes of an archive of plots as it is written.
+
+    Plots are read concurrently, but no more than `ARCHIVE_READ_AHEAD`
+    reads are in flight or waiting to be written at any time.
+    """
+
+    sink = StreamSink()
+    if archive_format == "zip":
+        # Plots are already compressed, so just store them.
+        archive = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED)
+    else:
+        archive = tarfile.open(fileobj=sink, mode="w|")
+
+    def add_member(name, data):
+        if archive_format == "zip":
+            archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(data))
+
+    pending = deque()
+    errors = []
+
+    def write_next():
+        ref_dict, future = pending.popleft()
+        try:
+            add_member(archive_member_name(plot_type, ref_dict), future.result())
+        except Exception as e:
+            errors.append(f"{ref_dict['id']}: {e}")
+        return sink.drain()
+
+    try:
+        for ref_dict, resource_path, error in plots:
+            if len(pending) >= ARCHIVE_READ_AHEAD:
+                yield write_next()
+            pending.append((ref_dict, archive_executor.submit(read_plot, resource_path, error)))
+
+        while pending:
+            yield write_next()
+
+        if errors:
+            add_member("errors.txt", "\n".join(errors).encode())
+        archive.close()
+        yield sink.drain()
+    finally:
+        # The client may have gone away part way through.
+        for _, future in pending:
+            future.cancel()
+
+@bp.route("/archive/<url:repo>/<plot_type>")
+def archive(repo, plot_type):
+    """Stream every plot of one dataset type in a collection
+    as a zip or tar file, using the plot cache entries.
+    """
+
+    if repo not in REPO_NAMES:
+        return {"error": f"Invalid repo {repo}"}, 400
+
+    collection = request.args.get("collection")
+    if collection is None:
+        return {"error": "Must specify a collection"}, 400
+
+    archive_format = request.args.get("format", "zip")
+    if archive_format not in ("zip", "tar"):
+        return {"error": f"Invalid archive format {archive_format}"}, 400
+
+    summary = cache.read_collection_summary(repo, collection)
+    if summary is None:
+        return {"error": f"No plot cache for collection {collection}"}, 404
+
+    ref_dicts = []
+    for section in summary.values():
+        ref_dicts.extend(section.get(plot_type, []))
+    if len(ref_dicts) == 0:
+        return {"error": f"No {plot_type} plots in collection {collection}"}, 404
+
+    # Resolve every plot up front, so that the Butler goes back to the
+    # pool before the download starts rather than when it finishes.
+    plots = resolve_plots(get_butler_map(repo), ref_dicts)
+    release_request_butler(repo)
 
+    filename = f"{collection.replace('/', '_')}_{plot_type}.{archive_format}"
+    return Response(
+        stream_with_context(generate_archive(plot_type, plots, archive_format)),
+        mimetype="application/zip" if archive_format == "zip" else "application/x-tar",
+        headers={"Content-Disposition": f"attachment; filename={filename}"})
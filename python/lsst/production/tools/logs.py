@@ -25,6 +25,8 @@ import sys
 import lsst.daf.butler as dafButler
 from flask import Blueprint, Flask, jsonify, render_template, request
 
+from .butlerPool import request_butler
+
 bp = Blueprint("logs", __name__, url_prefix="/logs")
 
 #try:
@@ -33,10 +35,8 @@ bp = Blueprint("logs", __name__, url_prefix="/logs")
 #    print("Must set environment variable BUTLER_URI")
 #    sys.exit(1)
 
-#global_butler = dafButler.Butler(BUTLER_URI)
-
 def get_butler():
-    return global_butler
+    return request_butler(os.getenv("BUTLER_URI"))
 
 
 @bp.route("/")
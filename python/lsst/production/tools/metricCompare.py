@@ -0,0 +1,163 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import warnings
+
+import numpy as np
+
+from .htmlUtils import column_array, top_k
+
+
+def table_keys(t, key_cols):
+    """Return the join keys of a table, as a plain array for one key
+    column or a record array for several.
+    """
+    if len(key_cols) == 1:
+        return np.asarray(t[key_cols[0]])
+    return np.rec.fromarrays([np.asarray(t[col]) for col in key_cols], names=key_cols)
+
+
+def match_rows(base, new, key_cols):
+    """Align the rows of two tables on their key columns.
+
+    The keys are sorted and intersected, so this scales as
+    n log n. If a key is repeated only its first row is matched.
+
+    Returns
+    -------
+    base_rows, new_rows : `numpy.ndarray`
+        The indices of the matching rows in each table, in key order.
+    """
+    _, base_rows, new_rows = np.intersect1d(
+        table_keys(base, key_cols), table_keys(new, key_cols), return_indices=True
+    )
+    return base_rows, new_rows
+
+
+def threshold_arrays(metric_list, metric_defs):
+    """Return the low and high thresholds of each metric, -inf and inf
+    for metrics without thresholds.
+    """
+    low = np.full(len(metric_list), -np.inf)
+    high = np.full(len(metric_list), np.inf)
+    for n, metric in enumerate(metric_list):
+        if metric in metric_defs:
+            low[n] = metric_defs[metric]["lowThreshold"]
+            high[n] = metric_defs[metric]["highThreshold"]
+    return low, high
+
+
+def compare_tables(base, new, key_cols, metric_list, metric_defs, n_worst=20):
+    """Compare the metrics of two runs row by row.
+
+    Parameters
+    ----------
+    base : `astropy.table.Table`
+        The metrics table of the earlier run.
+    new : `astropy.table.Table`
+        The metrics table of the run to check.
+    key_cols : `list` of `str`
+        The columns to align the rows on, e.g. ["tract"] or
+        ["visit", "detector"].
+    metric_list : `list` of `str`
+        The metric columns to compare; they must be in both tables.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    n_worst : `int`
+        The number of regressions to return.
+
+    Returns
+    -------
+    comparison : `dict`
+        The numbers of matched and unmatched rows, a summary of the
+        changes in each metric, and the largest regressions: values
+        that newly fail their thresholds, ordered by how far they
+        moved in units of the sigmaMAD of the earlier run.
+    """
+    base_rows, new_rows = match_rows(base, new, key_cols)
+    n_matched = len(base_rows)
+
+    base_values = np.empty((len(metric_list), n_matched))
+    new_values = np.empty((len(metric_list), n_matched))
+    for n, metric in enumerate(metric_list):
+        base_values[n] = column_array(base[metric])[base_rows]
+        new_values[n] = column_array(new[metric])[new_rows]
+
+    low, high = threshold_arrays(metric_list, metric_defs)
+    delta = new_values - base_values
+    with np.errstate(invalid="ignore"):
+        base_bad = (base_values < low[:, None]) | (base_values > high[:, None])
+        new_bad = (new_values < low[:, None]) | (new_values > high[:, None])
+    new_failures = new_bad & ~base_bad
+    resolved = base_bad & ~new_bad
+
+    with warnings.catch_warnings():
+        # Metrics with no matched values just give NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median_delta = np.nanmedian(delta, axis=1)
+        base_median = np.nanmedian(base_values, axis=1, keepdims=True)
+        sigma_mad = 1.4826 * np.nanmedian(np.fabs(base_values - base_median), axis=1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = np.fabs(delta) / sigma_mad
+    scores[np.isnan(scores)] = -np.inf
+    scores[~new_failures] = -np.inf
+
+    base_ids = table_keys(base, key_cols)[base_rows]
+    regressions = []
+    for flat in top_k(scores.ravel(), n_worst):
+        n, row = divmod(flat, n_matched)
+        regressions.append({
+            "key": dict(zip(key_cols, key_values(base_ids[row]))),
+            "metric": metric_list[n],
+            "base": float(base_values[n, row]),
+            "new": float(new_values[n, row]),
+            "delta": float(delta[n, row]),
+            "score": float(scores[n, row]),
+        })
+
+    metrics = {}
+    for n, metric in enumerate(metric_list):
+        metrics[metric] = {
+            "median_delta": None if np.isnan(median_delta[n]) else float(median_delta[n]),
+            "n_new_failures": int(new_failures[n].sum()),
+            "n_resolved": int(resolved[n].sum()),
+            "n_base_failures": int(base_bad[n].sum()),
+            "n_new_run_failures": int(new_bad[n].sum()),
+        }
+
+    return {
+        "key_cols": list(key_cols),
+        "n_matched": n_matched,
+        "n_base_only": len(base) - n_matched,
+        "n_new_only": len(new) - n_matched,
+        "n_new_failures": int(new_failures.sum()),
+        "n_resolved": int(resolved.sum()),
+        "metrics": metrics,
+        "regressions": regressions,
+    }
+
+
+def key_values(key):
+    """Return the values of one join key as plain python values."""
+    if isinstance(key, np.record):
+        return [value.item() if hasattr(value, "item") else value for value in key]
+    return [key.item() if hasattr(key, "item") else key]
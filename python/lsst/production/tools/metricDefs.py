@@ -0,0 +1,145 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from collections.abc import Mapping
+from types import MappingProxyType
+
+import boto3
+import botocore
+import yaml
+
+
+def freeze(obj):
+    """Return a read-only copy of a structure parsed from yaml."""
+    if isinstance(obj, dict):
+        return MappingProxyType({key: freeze(value) for key, value in obj.items()})
+    if isinstance(obj, list):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+class MetricDefs(Mapping):
+    """Read-only metric thresholds keyed by metric column name.
+
+    Parameters
+    ----------
+    defs : `dict`
+        The parsed contents of metricInformation.yaml.
+    etag : `str`, optional
+        ETag of the S3 object the definitions were read from, which
+        identifies this version of the definitions.
+    """
+
+    def __init__(self, defs, etag=None):
+        self._defs = freeze(defs or {})
+        self.etag = etag
+
+    def __getitem__(self, key):
+        return self._defs[key]
+
+    def __iter__(self):
+        return iter(self._defs)
+
+    def __len__(self):
+        return len(self._defs)
+
+
+class MetricDefsCache:
+    """Keeps a parsed copy of the metric thresholds file, and checks
+    S3 for a newer version at most once every ``revalidate_interval``
+    seconds.
+
+    Parameters
+    ----------
+    key : `str`
+        Key of the thresholds file in the plot navigator bucket.
+    revalidate_interval : `float`
+        Seconds to use the cached copy before checking its ETag again.
+    """
+
+    def __init__(self, key="metricInformation.yaml", revalidate_interval=60):
+        self.key = key
+        self.revalidate_interval = revalidate_interval
+        self._defs = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._s3_client = None
+
+    def get(self):
+        """Return the current metric definitions.
+
+        Returns
+        -------
+        metric_defs : `MetricDefs`
+            The metric thresholds; empty if the file has never been
+            read successfully.
+        """
+        defs = self._defs
+        if defs is not None and time.monotonic() - self._checked < self.revalidate_interval:
+            return defs
+
+        # Only one thread revalidates; the others keep using the
+        # copy they have unless there isn't one yet.
+        if not self._lock.acquire(blocking=defs is None):
+            return defs
+        try:
+            if self._defs is None or time.monotonic() - self._checked >= self.revalidate_interval:
+                self._revalidate()
+            return self._defs
+        finally:
+            self._lock.release()
+
+    def _revalidate(self):
+        if self._s3_client is None:
+            session = boto3.Session(profile_name="rubin-plot-navigator")
+            self._s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+
+        kwargs = {}
+        if self._defs is not None and self._defs.etag is not None:
+            kwargs["IfNoneMatch"] = self._defs.etag
+
+        try:
+            response = self._s3_client.get_object(
+                Bucket="rubin-plot-navigator", Key=self.key, **kwargs
+            )
+            self._defs = MetricDefs(yaml.safe_load(response["Body"]), response["ETag"])
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("304", "NotModified"):
+                print(e)
+        except botocore.exceptions.BotoCoreError as e:
+            print(e)
+
+        if self._defs is None:
+            self._defs = MetricDefs({})
+        self._checked = time.monotonic()
+
+
+metric_defs_cache = MetricDefsCache(
+    revalidate_interval=int(os.getenv("METRIC_DEFS_REVALIDATE_INTERVAL", "60"))
+)
+
+
+def get_metric_defs():
+    """Return the shared, cached metric thresholds."""
+    return metric_defs_cache.get()
@@ -0,0 +1,158 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import botocore
+import numpy as np
+
+from . import cache
+from .cacheUtils import LRUCache
+from .htmlUtils import column_array
+from .metricsTables import find_metrics_tables, get_row_index, load_rows, table_columns
+from .tableLayouts import layout_metric_columns
+from .tableSchema import get_schema_index
+
+# The plot cache sections that hold the plots of each kind of id
+PLOT_SECTIONS = {"tract": "tracts", "visit": "visits"}
+
+# {(repo, collection): {(id column, id): [(plot type, uuid)]}}
+plot_indexes = LRUCache(maxsize=32, ttl=600)
+
+
+def get_plot_index(repo, collection):
+    """Return the plots in the plot cache file of a collection, keyed
+    by tract or visit, reading the file only once.
+    """
+    index = plot_indexes.get((repo, collection))
+    if index is None:
+        try:
+            summary = cache.read_collection_summary(repo, collection)
+        except botocore.exceptions.BotoCoreError as e:
+            # The metrics are still worth showing without the plots
+            print(e)
+            return {}
+        index = {}
+        if summary is not None:
+            for id_col, section in PLOT_SECTIONS.items():
+                for plot_type, ref_dicts in summary.get(section, {}).items():
+                    for ref_dict in ref_dicts:
+                        data_id = json.loads(ref_dict["dataId"])
+                        if id_col in data_id:
+                            index.setdefault((id_col, str(data_id[id_col])), []).append(
+                                (plot_type, ref_dict["id"])
+                            )
+        plot_indexes.put((repo, collection), index)
+    return index
+
+
+def table_row_metrics(repo, ref, id_col, id_val, metric_defs):
+    """Check the metrics of the rows of a table with one id.
+
+    The rows are found with the table's `RowIndex`, and only they are
+    read from the table's metric columns.
+
+    Returns
+    -------
+    drill_down : `dict` or None
+        The row labels, and the values and failures of each metric
+        for each row, or None if the table has no rows with the id.
+    """
+    index = get_row_index(repo, ref)
+    if index is None or index.id_col != id_col:
+        return None
+
+    schema = table_columns(repo, ref)
+    metric_columns = layout_metric_columns(schema, ref.datasetType.name, metric_defs)
+    label_col = "detector" if "detector" in schema and id_col != "detector" else id_col
+    columns = list(dict.fromkeys([id_col, label_col] + metric_columns))
+    row_t = load_rows(repo, ref, columns, index, id_val)
+    if row_t is None:
+        return None
+
+    values = np.empty((len(metric_columns), len(row_t)))
+    for n, col in enumerate(metric_columns):
+        values[n] = column_array(row_t[col])
+    low = np.array([metric_defs[col]["lowThreshold"] if col in metric_defs else -np.inf
+                    for col in metric_columns], dtype=float)
+    high = np.array([metric_defs[col]["highThreshold"] if col in metric_defs else np.inf
+                     for col in metric_columns], dtype=float)
+    with np.errstate(invalid="ignore"):
+        bad = (values < low[:, None]) | (values > high[:, None])
+
+    parsed = get_schema_index(schema)
+    metrics = []
+    for n, col in enumerate(metric_columns):
+        metric, band, statistic = parsed.parse(col)
+        metric_def = metric_defs.get(col, {})
+        metrics.append({
+            "column": col,
+            "metric": metric,
+            "band": band,
+            "statistic": statistic,
+            "low": metric_def.get("lowThreshold"),
+            "high": metric_def.get("highThreshold"),
+            "debug_group": metric_def.get("debugGroup"),
+            "values": [f"{val:.3g}" for val in values[n].tolist()],
+            "bad": bad[n].tolist(),
+        })
+
+    return {
+        "table_name": ref.datasetType.name,
+        "label_col": label_col,
+        "labels": [str(label) for label in np.asarray(row_t[label_col]).tolist()],
+        "n_failures": int(bad.sum()),
+        "metrics": metrics,
+    }
+
+
+def drill_down(repo, collection, id_col, id_val, metric_defs):
+    """Collect everything known about one tract or visit.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    collection : `str`
+        Butler collection.
+    id_col : `str`
+        "tract" or "visit".
+    id_val : `str`
+        The tract or visit.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+
+    Returns
+    -------
+    tables : `list` of `dict`
+        The `table_row_metrics` of each metrics table with the id.
+    plots : `list` of `tuple`
+        The plot type and uuid of each plot of the id in the plot
+        cache file of the collection.
+    """
+    tables = []
+    for table_name, ref in sorted(find_metrics_tables(repo, collection).items()):
+        table = table_row_metrics(repo, ref, id_col, id_val, metric_defs)
+        if table is not None:
+            tables.append(table)
+
+    plots = sorted(get_plot_index(repo, collection).get((id_col, str(id_val)), []))
+    return tables, plots
@@ -0,0 +1,132 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+from lsst.daf.butler.formatters.parquet import astropy_to_arrow
+
+from .images import StreamSink
+
+# Number of rows written at a time
+EXPORT_BATCH_ROWS = int(os.getenv("METRICS_EXPORT_BATCH_ROWS", "10000"))
+
+# {format: (mimetype, file extension)}
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+class ArrowSink(StreamSink):
+    """A `StreamSink` that pyarrow can write to, which needs to be
+    able to tell that it is open.
+    """
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def flag_column_name(col):
+    return f"{col}_fail"
+
+
+def export_batches(t, columns, failure_masks, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield a metrics table as arrow tables of at most ``batch_rows``
+    rows, with a failure flag column for each thresholded metric.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The metrics table, which is not copied.
+    columns : `list` of `str`
+        The columns to export.
+    failure_masks : `dict`
+        The `metricReports.FailureMask` of each thresholded column to
+        add a ``<column>_fail`` flag for.
+    batch_rows : `int`
+        The number of rows in each batch.
+
+    Yields
+    ------
+    batch : `pyarrow.Table`
+        The columns, then the flags, then ``n_failed_metrics``, the
+        number of flags that are set in each row.
+    """
+    flagged = [col for col in columns if col in failure_masks]
+    for start in range(0, max(len(t), 1), batch_rows):
+        stop = min(start + batch_rows, len(t))
+        batch = astropy_to_arrow(t[start:stop][columns])
+        n_failed = np.zeros(stop - start, dtype=np.int32)
+        for col in flagged:
+            flags = failure_masks[col].mask[start:stop]
+            n_failed += flags
+            batch = batch.append_column(flag_column_name(col), pa.array(flags))
+        yield batch.append_column("n_failed_metrics", pa.array(n_failed))
+
+
+def generate_csv(batches):
+    """Yield the bytes of a CSV file, one batch at a time."""
+    sink = ArrowSink()
+    for n, batch in enumerate(batches):
+        pyarrow.csv.write_csv(batch, sink, pyarrow.csv.WriteOptions(include_header=(n == 0)))
+        yield sink.drain()
+
+
+def generate_parquet(batches):
+    """Yield the bytes of a Parquet file, with one row group for
+    each batch.
+    """
+    sink = ArrowSink()
+    writer = None
+    for batch in batches:
+        if writer is None:
+            writer = pq.ParquetWriter(sink, batch.schema)
+        writer.write_table(batch)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def generate_export(t, columns, failure_masks, export_format):
+    """Yield the bytes of a metrics table export as it is written.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The metrics table.
+    columns : `list` of `str`
+        The columns to export.
+    failure_masks : `dict`
+        The `metricReports.FailureMask` of each thresholded column.
+    export_format : `str`
+        "csv" or "parquet".
+    """
+    batches = export_batches(t, columns, failure_masks)
+    if export_format == "csv":
+        return generate_csv(batches)
+    return generate_parquet(batches)
@@ -0,0 +1,189 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import warnings
+
+import numpy as np
+
+from .cacheUtils import LRUCache
+from .metricsTables import load_table
+from .tableSchema import get_schema_index
+
+# Number of bins in each histogram
+HISTOGRAM_BINS = int(os.getenv("METRICS_HISTOGRAM_BINS", "40"))
+
+# Columns that identify rows rather than measure anything
+KEY_COLUMNS = {"tract", "patch", "visit", "detector", "day_obs", "physical_filter"}
+
+# Percentiles of the values the bins cover, so that a few outliers
+# do not squash every other value into one bin
+HISTOGRAM_RANGE = (0.5, 99.5)
+
+# {(repo, dataset id): histograms}
+histogram_cache = LRUCache(maxsize=int(os.getenv("METRICS_HISTOGRAM_CACHE_SIZE", "64")))
+
+
+def histogram_ranges(values, percentiles=HISTOGRAM_RANGE):
+    """Return the range of the bins of each row of a 2D array.
+
+    Rows with no finite values get a range of (0, 1), and rows where
+    every value is the same get a range of width 1 around that value.
+    """
+    with warnings.catch_warnings():
+        # All NaN rows give NaN percentiles
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lo, hi = np.nanpercentile(values, percentiles, axis=1)
+    empty = ~np.isfinite(lo) | ~np.isfinite(hi)
+    lo[empty] = 0.0
+    hi[empty] = 1.0
+    flat = hi <= lo
+    lo[flat] -= 0.5
+    hi[flat] += 0.5
+    return lo, hi
+
+
+def bin_counts(values, lo, hi, n_bins):
+    """Histogram every row of a 2D array at once.
+
+    Each row is binned into ``n_bins`` equal bins between its ``lo``
+    and ``hi``, giving the same counts as `numpy.histogram` with that
+    range, and all the rows are counted with a single
+    `numpy.bincount`.
+
+    Returns
+    -------
+    counts : `numpy.ndarray`
+        The counts, with one row for each row of values.
+    n_below, n_above, n_nan : `numpy.ndarray`
+        The number of values of each row below and above the range,
+        and the number that are NaN.
+    """
+    n_rows = values.shape[0]
+    width = (hi - lo) / n_bins
+    with np.errstate(invalid="ignore"):
+        scaled = (values - lo[:, None]) / width[:, None]
+        below = scaled < 0
+        above = values > hi[:, None]
+    nan = np.isnan(values)
+    inside = ~(below | above | nan)
+
+    # The top edge belongs to the last bin, as in numpy.histogram
+    bins = np.minimum(scaled[inside].astype(np.int64), n_bins - 1)
+    rows = np.broadcast_to(np.arange(n_rows)[:, None], values.shape)[inside]
+    counts = np.bincount(rows * n_bins + bins, minlength=n_rows * n_bins)
+    return counts.reshape(n_rows, n_bins), below.sum(axis=1), above.sum(axis=1), nan.sum(axis=1)
+
+
+def histogram_columns(t):
+    """Return the numeric columns of a table that are not row keys."""
+    return [col for col in t.colnames
+            if col not in KEY_COLUMNS and t[col].dtype.kind in "biuf" and t[col].ndim == 1]
+
+
+def table_histograms(t, columns, n_bins=HISTOGRAM_BINS):
+    """Make the histograms of the metric columns of a table.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The metrics table.
+    columns : `list` of `str`
+        The metric columns to histogram.
+    n_bins : `int`
+        The number of bins in each histogram.
+
+    Returns
+    -------
+    histograms : `list` of `dict`
+        For each column, its metric, band and statistic, the range
+        and counts of the bins, the number of values outside the
+        range and the number of NaN values, all json serializable.
+    """
+    values = np.empty((len(columns), len(t)))
+    for n, col in enumerate(columns):
+        values[n] = np.ma.asarray(t[col], dtype=float).filled(np.nan)
+
+    lo, hi = histogram_ranges(values)
+    counts, n_below, n_above, n_nan = bin_counts(values, lo, hi, n_bins)
+
+    schema = get_schema_index(t.colnames)
+    histograms = []
+    for n, col in enumerate(columns):
+        metric, band, statistic = schema.parse(col)
+        histograms.append({
+            "column": col,
+            "metric": metric,
+            "band": band,
+            "statistic": statistic,
+            "range": [float(lo[n]), float(hi[n])],
+            "counts": counts[n].tolist(),
+            "n_below": int(n_below[n]),
+            "n_above": int(n_above[n]),
+            "n_nan": int(n_nan[n]),
+        })
+    return histograms
+
+
+def get_table_histograms(repo, ref):
+    """Return the histograms of every numeric column of a metrics
+    table, making them only the first time the dataset is seen.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+
+    Returns
+    -------
+    histograms : `list` of `dict`
+        The `table_histograms` of the table, which are shared and must
+        not be modified.
+    """
+    key = (repo, ref.id)
+    histograms = histogram_cache.get(key)
+    if histograms is None:
+        t = load_table(repo, ref)
+        histograms = table_histograms(t, histogram_columns(t))
+        histogram_cache.put(key, histograms)
+    return histograms
+
+
+def add_thresholds(histograms, metric_defs):
+    """Return copies of histograms with the thresholds of their
+    metrics, which are None for metrics without thresholds.
+
+    The thresholds are added when the histograms are served rather than
+    when they are made, so that the cached histograms do not depend on
+    the version of the metric definitions.
+    """
+    with_thresholds = []
+    for histogram in histograms:
+        metric_def = metric_defs.get(histogram["column"], {})
+        with_thresholds.append(dict(
+            histogram,
+            low=metric_def.get("lowThreshold"),
+            high=metric_def.get("highThreshold"),
+            debug_group=metric_def.get("debugGroup"),
+        ))
+    return with_thresholds
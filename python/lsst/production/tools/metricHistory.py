@@ -0,0 +1,321 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import threading
+import time
+import urllib.parse
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from lsst.resources import ResourcePath
+
+from .butlerPool import butler_pool
+from .htmlUtils import column_array
+from .metricDefs import get_metric_defs
+from .tableLayouts import layout_metric_columns
+from .tableSchema import get_schema_index
+
+# Where the history is kept, a local directory or an S3 URI; nothing
+# is recorded if this is not set.
+HISTORY_URI = os.getenv("METRIC_HISTORY_URI")
+
+HISTORY_SCHEMA = pa.schema([
+    ("run", pa.string()),
+    ("dataset_id", pa.string()),
+    ("recorded", pa.timestamp("s", tz="UTC")),
+    ("column", pa.string()),
+    ("metric", pa.string()),
+    ("band", pa.string()),
+    ("statistic", pa.string()),
+    ("n_rows", pa.int64()),
+    ("n_nan", pa.int64()),
+    ("median", pa.float64()),
+    ("sigma_mad", pa.float64()),
+    ("low", pa.float64()),
+    ("high", pa.float64()),
+    ("n_fail", pa.int64()),
+])
+
+# The columns a trend query reads
+TREND_COLUMNS = ["run", "recorded", "column", "metric", "band", "statistic",
+                 "n_rows", "median", "sigma_mad", "n_fail"]
+
+history_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metric-history")
+
+
+def history_root():
+    return ResourcePath(HISTORY_URI, forceDirectory=True)
+
+
+def table_dir(repo, table_name):
+    return history_root().join(f"{urllib.parse.quote_plus(repo)}/table={table_name}/", forceDirectory=True)
+
+
+def history_path(repo, table_name, ref):
+    """Return where the summary of one metrics table dataset is kept.
+
+    The history is partitioned by repository, table and run, with
+    one Parquet file for each dataset.
+    """
+    run = urllib.parse.quote_plus(ref.run)
+    return table_dir(repo, table_name).join(f"run={run}/{ref.id}.parquet")
+
+
+def summarize_metrics(t, columns, metric_defs):
+    """Work out the summary statistics of metric columns, all at once.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The metrics table.
+    columns : `list` of `str`
+        The metric columns to summarize.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+
+    Returns
+    -------
+    summary : `dict`
+        Arrays of the median, sigmaMAD, NaN count, thresholds and
+        failure count of each column, keyed by the `HISTORY_SCHEMA`
+        field names.
+    """
+    values = np.empty((len(columns), len(t)))
+    for n, col in enumerate(columns):
+        values[n] = column_array(t[col])
+
+    low = np.array([metric_defs[col]["lowThreshold"] if col in metric_defs else np.nan
+                    for col in columns], dtype=float)
+    high = np.array([metric_defs[col]["highThreshold"] if col in metric_defs else np.nan
+                     for col in columns], dtype=float)
+
+    with warnings.catch_warnings():
+        # All NaN columns just give NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(values, axis=1)
+        sigma_mad = 1.4826 * np.nanmedian(np.fabs(values - median[:, None]), axis=1)
+    with np.errstate(invalid="ignore"):
+        n_fail = ((values < low[:, None]) | (values > high[:, None])).sum(axis=1)
+
+    return {
+        "n_rows": np.full(len(columns), len(t)),
+        "n_nan": np.isnan(values).sum(axis=1),
+        "median": median,
+        "sigma_mad": sigma_mad,
+        "low": low,
+        "high": high,
+        "n_fail": n_fail,
+    }
+
+
+def write_history(repo, ref, t, columns, metric_defs):
+    """Append the summary of one metrics table dataset to the history.
+
+    Returns
+    -------
+    written : `bool`
+        False if the dataset was already in the history.
+    """
+    table_name = ref.datasetType.name
+    summary = summarize_metrics(t, columns, metric_defs)
+    schema = get_schema_index(t.colnames)
+    parsed = [schema.parse(col) for col in columns]
+
+    data = dict(summary)
+    data.update({
+        "run": [ref.run] * len(columns),
+        "dataset_id": [str(ref.id)] * len(columns),
+        "recorded": [datetime.now(timezone.utc).replace(microsecond=0)] * len(columns),
+        "column": columns,
+        "metric": [metric for metric, _, _ in parsed],
+        "band": [band for _, band, _ in parsed],
+        "statistic": [statistic for _, _, statistic in parsed],
+    })
+    history = pa.Table.from_pydict(data, schema=HISTORY_SCHEMA)
+
+    buffer = io.BytesIO()
+    pq.write_table(history, buffer)
+    try:
+        history_path(repo, table_name, ref).write(buffer.getvalue(), overwrite=False)
+    except FileExistsError:
+        return False
+    return True
+
+
+def record_history(repo, ref, t=None, colnames=None):
+    """Summarize a metrics table dataset into the history, if it is
+    not there already.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+    t : `astropy.table.Table`, optional
+        The table, if it has already been loaded; it is only read
+        again if it lacks some of the metric columns.
+    colnames : `list` of `str`, optional
+        All the column names of the table, needed to use ``t``.
+    """
+    path = history_path(repo, ref.datasetType.name, ref)
+    if path.exists():
+        return
+
+    metric_defs = get_metric_defs()
+    if t is not None and colnames is not None:
+        columns = layout_metric_columns(colnames, ref.datasetType.name, metric_defs)
+        if all(col in t.colnames for col in columns):
+            if len(columns) > 0:
+                write_history(repo, ref, t, columns, metric_defs)
+            return
+
+    with butler_pool.butler(repo) as butler:
+        colnames = list(butler.get(ref.makeComponentRef("columns")))
+        columns = layout_metric_columns(colnames, ref.datasetType.name, metric_defs)
+        if len(columns) == 0:
+            return
+        t = butler.get(ref, parameters={"columns": columns})
+    write_history(repo, ref, t, columns, metric_defs)
+
+
+recorded = set()
+
+
+def record_history_in_background(repo, ref, t=None, colnames=None):
+    """Queue a metrics table dataset to be added to the history, the
+    first time it is seen by this process.
+
+    The arguments are as for `record_history`.
+    """
+    if HISTORY_URI is None or (repo, ref.id) in recorded:
+        return
+    recorded.add((repo, ref.id))
+
+    def record():
+        try:
+            record_history(repo, ref, t, colnames)
+        except Exception as e:
+            print(f"Could not record the metric history of {ref}: {e}")
+
+    history_executor.submit(record)
+
+
+def read_history_file(path, columns):
+    if path.isLocal:
+        return pq.read_table(path.ospath, columns=columns)
+    return pq.read_table(io.BytesIO(path.read()), columns=columns)
+
+
+class HistoryReader:
+    """Keeps the history of each table in memory, adding files that
+    have appeared since it was last listed.
+
+    Parameters
+    ----------
+    ttl : `float`
+        Seconds before the files of a table are listed again.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._tables = {}
+        self._table_locks = {}
+        self._lock = threading.Lock()
+
+    def read(self, repo, table_name):
+        """Return the history of a table, with the `TREND_COLUMNS`."""
+        key = (repo, table_name)
+        with self._lock:
+            files, listed = self._tables.get(key, ({}, 0.0))
+            table_lock = self._table_locks.setdefault(key, threading.Lock())
+
+        if time.monotonic() - listed > self.ttl:
+            # Only one request lists each table at a time, and requests
+            # for other tables carry on meanwhile.
+            with table_lock:
+                with self._lock:
+                    files, listed = self._tables.get(key, ({}, 0.0))
+                if time.monotonic() - listed > self.ttl:
+                    files = self._refresh(repo, table_name, files)
+                    with self._lock:
+                        self._tables[key] = (files, time.monotonic())
+
+        if len(files) == 0:
+            return HISTORY_SCHEMA.empty_table().select(TREND_COLUMNS)
+        return pa.concat_tables(files.values())
+
+    def _refresh(self, repo, table_name, files):
+        """Return a copy of ``files`` with any new history files
+        of a table added.
+        """
+        files = dict(files)
+        directory = table_dir(repo, table_name)
+        paths = []
+        if directory.exists():
+            paths = ResourcePath.findFileResources([directory], file_filter=r"\.parquet$")
+        for path in paths:
+            if str(path) not in files:
+                files[str(path)] = read_history_file(path, TREND_COLUMNS)
+        return files
+
+
+history_reader = HistoryReader(ttl=int(os.getenv("METRIC_HISTORY_TTL", "60")))
+
+
+def metric_trend(repo, table_name, metric, band=None, statistic=None):
+    """Return the history of a metric across runs.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository
+    table_name : `str`
+        The metrics table dataset type.
+    metric : `str`
+        A column name, or a metric name as parsed by `SchemaIndex`.
+    band : `str`, optional
+        Only include this band.
+    statistic : `str`, optional
+        Only include this statistic.
+
+    Returns
+    -------
+    points : `list` of `dict`
+        One entry per run and column, in the order they were recorded.
+    """
+    history = history_reader.read(repo, table_name)
+    mask = pc.or_(pc.equal(history["column"], metric), pc.equal(history["metric"], metric))
+    if band is not None:
+        mask = pc.and_(mask, pc.equal(history["band"], band))
+    if statistic is not None:
+        mask = pc.and_(mask, pc.equal(history["statistic"], statistic))
+    points = history.filter(mask).sort_by(
+        [("recorded", "ascending"), ("run", "ascending"), ("column", "ascending")]
+    )
+    return points.to_pylist()
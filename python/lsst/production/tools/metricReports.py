@@ -0,0 +1,190 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+import numpy as np
+
+from .cacheUtils import LRUCache
+from .htmlUtils import top_k
+from .metricsTables import load_table, table_columns
+from .tableLayouts import table_id_col
+
+# Number of failures listed on a report page
+REPORT_MAX_ROWS = int(os.getenv("METRICS_REPORT_MAX_ROWS", "1000"))
+
+
+class FailureMask:
+    """The rows of a table column that fail the metric thresholds.
+
+    Parameters
+    ----------
+    values : `numpy.ndarray`
+        The values of the column, with NaN for missing values.
+    low, high : `float`
+        The thresholds; NaN values never fail.
+
+    Attributes
+    ----------
+    mask : `numpy.ndarray`
+        True for each failing row.
+    rows : `numpy.ndarray`
+        The failing rows, most severe first.
+    severity : `numpy.ndarray`
+        How far each failing row is outside the thresholds, in units
+        of the distance between them when both are finite.
+    values : `numpy.ndarray`
+        The values of the failing rows.
+    """
+
+    def __init__(self, values, low, high):
+        with np.errstate(invalid="ignore"):
+            self.mask = (values < low) | (values > high)
+        failing = np.flatnonzero(self.mask)
+        failing_values = values[failing]
+        excess = np.where(failing_values < low, low - failing_values, failing_values - high)
+        width = high - low
+        if np.isfinite(width) and width > 0:
+            excess = excess / width
+        order = np.argsort(-excess, kind="stable")
+        self.rows = failing[order]
+        self.severity = excess[order]
+        self.values = failing_values[order]
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + self.rows.nbytes + self.severity.nbytes + self.values.nbytes
+
+
+# {(repo, dataset id, column, low, high): FailureMask}
+failure_masks = LRUCache(
+    maxsize=int(os.getenv("METRICS_FAILURE_MASK_CACHE_SIZE", "512")),
+    maxbytes=int(os.getenv("METRICS_FAILURE_MASK_CACHE_BYTES", str(128 * 1024**2))),
+    sizeof=lambda mask: mask.nbytes,
+)
+
+
+def report_columns(metric, colnames, metric_defs):
+    """Return the thresholded columns a report covers: the column
+    itself if ``metric`` is a column name, and otherwise every column
+    in the debug group ``metric``.
+    """
+    if metric in metric_defs:
+        return [metric] if metric in colnames else []
+    return [col for col in colnames
+            if col in metric_defs and metric_defs[col].get("debugGroup") == metric]
+
+
+def get_failure_masks(repo, ref, columns, metric_defs):
+    """Return the `FailureMask` of each column, making only those
+    that have not been made for these thresholds before.
+
+    Only the columns whose masks are missing are loaded.
+    """
+    masks = {}
+    missing = []
+    for col in columns:
+        low = metric_defs[col]["lowThreshold"]
+        high = metric_defs[col]["highThreshold"]
+        mask = failure_masks.get((repo, ref.id, col, low, high))
+        if mask is None:
+            missing.append(col)
+        else:
+            masks[col] = mask
+
+    if len(missing) > 0:
+        t = load_table(repo, ref, missing)
+        for col in missing:
+            low = metric_defs[col]["lowThreshold"]
+            high = metric_defs[col]["highThreshold"]
+            masks[col] = FailureMask(np.ma.asarray(t[col], dtype=float).filled(np.nan), low, high)
+            failure_masks.put((repo, ref.id, col, low, high), masks[col])
+    return masks
+
+
+def metric_report(repo, ref, metric, metric_defs, max_rows=REPORT_MAX_ROWS):
+    """List the rows of a metrics table that fail a metric, or any
+    metric of a debug group.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+    metric : `str`
+        A metric column, or a debug group from the metric definitions.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+    max_rows : `int`
+        The number of failures to list.
+
+    Returns
+    -------
+    report : `dict` or None
+        The id column, the columns covered with their thresholds and
+        numbers of failures, the total number of failures, and the
+        most severe failures, each with its id, detector if the table
+        has one, column, value and severity. None if the table has no
+        id column or no columns for the metric.
+    """
+    schema = table_columns(repo, ref)
+    columns = report_columns(metric, schema, metric_defs)
+    id_col = table_id_col(ref.datasetType.name, schema)
+    if len(columns) == 0 or id_col is None:
+        return None
+    masks = get_failure_masks(repo, ref, columns, metric_defs)
+
+    # Merge the failures of all the columns and keep the worst
+    column_numbers = np.concatenate([np.full(len(masks[col].rows), n) for n, col in enumerate(columns)])
+    rows = np.concatenate([masks[col].rows for col in columns])
+    severity = np.concatenate([masks[col].severity for col in columns])
+    values = np.concatenate([masks[col].values for col in columns])
+    worst = np.array(top_k(severity, max_rows), dtype=int)
+
+    key_cols = [id_col] + (["detector"] if "detector" in schema and id_col != "detector" else [])
+    t = load_table(repo, ref, key_cols)
+    ids = np.asarray(t[id_col])[rows[worst]]
+    detectors = np.asarray(t["detector"])[rows[worst]] if len(key_cols) > 1 else None
+
+    failures = []
+    for n, index in enumerate(worst.tolist()):
+        failures.append({
+            "id": ids[n].item(),
+            "detector": None if detectors is None else detectors[n].item(),
+            "column": columns[column_numbers[index]],
+            "value": f"{values[index]:.3g}",
+            "severity": float(severity[index]),
+        })
+
+    return {
+        "id_col": id_col,
+        "columns": [{
+            "column": col,
+            "low": metric_defs[col]["lowThreshold"],
+            "high": metric_defs[col]["highThreshold"],
+            "debug_group": metric_defs[col].get("debugGroup"),
+            "n_fail": len(masks[col].rows),
+        } for col in columns],
+        "n_rows": len(t),
+        "n_failures": len(rows),
+        "failures": failures,
+    }
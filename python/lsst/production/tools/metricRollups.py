@@ -0,0 +1,265 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import os
+import urllib.parse
+from datetime import datetime, timezone
+
+import boto3
+import botocore
+import numpy as np
+from lsst.daf.butler import MissingDatasetTypeError
+
+from .htmlUtils import (
+    cell_contents, column_array, make_table_headers, make_table_rows, make_table_store, rank_worst
+)
+from .metricsTables import METRICS_TABLE_PATTERNS
+from .tableLayouts import get_table_layout, layout_column_patterns, resolve_columns, table_id_col
+from .tableSchema import get_schema_index
+
+# Number of failing ids kept for each metric
+MAX_FAILING_IDS = int(os.getenv("METRIC_ROLLUP_MAX_IDS", "100"))
+
+
+def rollups_key(repo, collection):
+    encoded_repo = urllib.parse.quote_plus(repo)
+    encoded_collection_name = urllib.parse.quote_plus(collection)
+    return f"{encoded_repo}/rollups_{encoded_collection_name}.json.gz"
+
+
+def to_json_value(value):
+    """Turn a numpy scalar into something json can write."""
+    return value.item() if hasattr(value, "item") else value
+
+
+def rollup_table(t, metric_list, id_col, metric_defs, k=3, n_ranked=10, layout=None):
+    """Count the failures of every thresholded metric in a table.
+
+    Parameters
+    ----------
+    t : `astropy.table.Table`
+        The metrics table, with at least the id column and the
+        columns of ``metric_list``.
+    metric_list : `list` of `str`
+        The metric columns with thresholds.
+    id_col : `str`
+        The name of the tract/visit id column.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds.
+    k : `int`
+        The number of worst rows kept for each metric.
+    n_ranked : `int`
+        The number of rows in the worst row ranking.
+    layout : `tuple`, optional
+        The `get_table_layout` of the table and its full list of
+        column names; if given, ``t`` must have the layout columns
+        and the cells of the ranked rows are included.
+
+    Returns
+    -------
+    rollup : `dict`
+        The numbers of rows, failing rows and failures, the failures of
+        each metric and band, and the worst rows from
+        `htmlUtils.rank_worst`, with their headers and cells for the
+        infoPage, all json serializable.
+    """
+    schema = get_schema_index(t.colnames)
+    values = np.empty((len(metric_list), len(t)))
+    for n, metric in enumerate(metric_list):
+        values[n] = column_array(t[metric])
+    low = np.array([metric_defs[metric]["lowThreshold"] for metric in metric_list], dtype=float)
+    high = np.array([metric_defs[metric]["highThreshold"] for metric in metric_list], dtype=float)
+
+    # All the thresholds are checked at once; NaN never fails
+    with np.errstate(invalid="ignore"):
+        bad = (values < low[:, None]) | (values > high[:, None])
+    n_fail = bad.sum(axis=1)
+    n_nan = np.isnan(values).sum(axis=1)
+    ids = np.asarray(t[id_col])
+
+    metrics = {}
+    bands = {}
+    for n, metric in enumerate(metric_list):
+        name, band, statistic = schema.parse(metric)
+        failing_ids = ids[bad[n]][:MAX_FAILING_IDS]
+        metrics[metric] = {
+            "metric": name,
+            "band": band,
+            "statistic": statistic,
+            "debug_group": metric_defs[metric].get("debugGroup"),
+            "low": to_json_value(low[n]),
+            "high": to_json_value(high[n]),
+            "n_fail": int(n_fail[n]),
+            "n_nan": int(n_nan[n]),
+            "failing_ids": [to_json_value(id_val) for id_val in failing_ids],
+        }
+        band_counts = bands.setdefault(band or "none", {"n_fail": 0, "n_metrics": 0})
+        band_counts["n_fail"] += int(n_fail[n])
+        band_counts["n_metrics"] += 1
+
+    worst, ranking, worst_rows = rank_worst(t, metric_list, id_col, k, n_ranked)
+
+    header_dict, rows = {}, []
+    if layout is not None:
+        (col_dict, headers, prefix), colnames = layout
+        header_dict, layout_bands = make_table_headers(colnames, headers)
+        store = make_table_store(t[worst_rows], col_dict, layout_bands, metric_defs, prefix)
+        rows = [(to_json_value(id_val), [cell_to_json(cell) for cell in cells])
+                for id_val, cells in make_table_rows(store)]
+
+    return {
+        "id_col": id_col,
+        "n_rows": len(t),
+        "n_failing_rows": int(bad.any(axis=0).sum()),
+        "n_failures": int(n_fail.sum()),
+        "metrics": metrics,
+        "bands": bands,
+        "worst": [(metric, val_str, to_json_value(id_val), score)
+                  for metric, val_str, id_val, score in worst],
+        "ranking": [(to_json_value(id_val), score, metric) for id_val, score, metric in ranking],
+        "headers": header_dict,
+        "rows": rows,
+    }
+
+
+def cell_to_json(cell):
+    return {"text": cell.text, "num_fails": int(cell.num_fails),
+            "link": cell.link, "debug_group": cell.debug_group}
+
+
+def rollup_rows(rollup):
+    """Return the ranked rows of a table rollup as `make_table_rows`
+    does, for the infoPage.
+    """
+    rows = []
+    for id_val, cells in rollup.get("rows", []):
+        row = []
+        for cell_dict in cells:
+            cell = cell_contents()
+            vars(cell).update(cell_dict)
+            row.append(cell)
+        rows.append((id_val, row))
+    return rows
+
+
+def rollup_collection(butler, collection, metric_defs):
+    """Roll up the metric failures of every metrics table in a collection.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.butler.Butler`
+        Butler for the repository.
+    collection : `str`
+        Collection to search for metrics tables.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds.
+
+    Returns
+    -------
+    tables : `dict`
+        A `rollup_table` result for each metrics table, keyed by
+        dataset type name.
+    """
+    try:
+        refs = list(butler.registry.queryDatasets(METRICS_TABLE_PATTERNS, collections=collection,
+                                                  findFirst=True))
+    except MissingDatasetTypeError:
+        refs = []
+
+    # Take the last ref of each table, as the metrics pages do
+    table_refs = {}
+    for ref in refs:
+        table_refs[ref.datasetType.name] = ref
+
+    tables = {}
+    for table_name, ref in sorted(table_refs.items()):
+        colnames = list(butler.get(ref.makeComponentRef("columns")))
+        id_col = table_id_col(table_name, colnames)
+        metric_list = [col for col in colnames if col in metric_defs]
+        if id_col is None or len(metric_list) == 0:
+            continue
+
+        # Only the thresholded columns, and those the infoPage shows
+        # for the ranked rows, are read
+        col_dict, headers, prefix = get_table_layout(table_name)
+        columns = [id_col] + metric_list
+        layout = None
+        if col_dict is not None and col_dict["id_col"] == id_col:
+            columns = resolve_columns(colnames, layout_column_patterns(col_dict, prefix) + metric_list)
+            layout = ((col_dict, headers, prefix), colnames)
+        t = butler.get(ref, parameters={"columns": columns})
+        tables[table_name] = rollup_table(t, metric_list, id_col, metric_defs, layout=layout)
+        tables[table_name]["dataset_id"] = str(ref.id)
+
+    return tables
+
+
+def write_metric_rollups(s3_client, repo, collection, tables, metric_defs_etag=None):
+    """Write the rollups of a collection to S3, gzipped.
+
+    Returns
+    -------
+    size : `int`
+        The compressed size of the rollups.
+    """
+    rollups = {
+        "repo": repo,
+        "collection": collection,
+        "updated": datetime.now(timezone.utc).isoformat(),
+        "metric_defs_etag": metric_defs_etag,
+        "tables": tables,
+    }
+    body = gzip.compress(json.dumps(rollups).encode())
+    s3_client.put_object(Body=body, Bucket="rubin-plot-navigator", Key=rollups_key(repo, collection),
+                         ContentType="application/json")
+    return len(body)
+
+
+def read_metric_rollups(repo, collection):
+    """Read the metric failure rollups of a collection from S3.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository
+    collection : `str`
+        Butler collection the rollups were made for.
+
+    Returns
+    -------
+    rollups : `dict` or None
+        The rollups, or None if none have been made for the collection.
+    """
+    try:
+        session = boto3.Session(profile_name="rubin-plot-navigator")
+        s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+        response = s3_client.get_object(Bucket="rubin-plot-navigator", Key=rollups_key(repo, collection))
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            print(e)
+        return None
+    except botocore.exceptions.BotoCoreError as e:
+        print(e)
+        return None
+
+    return json.loads(gzip.decompress(response["Body"].read()))
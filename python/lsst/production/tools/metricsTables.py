@@ -0,0 +1,381 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import urllib.parse
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from lsst.daf.butler import MissingDatasetTypeError
+from lsst.daf.butler.formatters.parquet import arrow_to_astropy, astropy_to_arrow
+from lsst.resources import ResourcePath
+
+from .butlerPool import request_butler
+from .cacheUtils import LRUCache
+from .metricHistory import record_history_in_background
+from .tableLayouts import table_id_col
+
+
+def table_nbytes(t):
+    """Return the memory used by the columns of an astropy table."""
+    return sum(col.nbytes for col in t.itercols())
+
+
+# Metrics tables never change once written, so a loaded table can be
+# kept for as long as there is room for it. Which dataset a collection
+# resolves to can change, so those lookups expire.
+table_cache = LRUCache(
+    maxsize=int(os.getenv("METRICS_TABLE_CACHE_SIZE", "64")),
+    maxbytes=int(os.getenv("METRICS_TABLE_CACHE_BYTES", str(512 * 1024**2))),
+    sizeof=table_nbytes,
+)
+ref_cache = LRUCache(maxsize=1024, ttl=int(os.getenv("METRICS_REF_TTL", "300")))
+column_cache = LRUCache(maxsize=1024)
+
+# Dataset type patterns of the metrics tables
+METRICS_TABLE_PATTERNS = ["*metrics_table*", "*metricsTable*"]
+
+# Row indexes are small, so they are kept for longer than the tables.
+row_index_cache = LRUCache(maxsize=int(os.getenv("METRICS_ROW_INDEX_CACHE_SIZE", "256")))
+
+# Optional on-disk copy of loaded tables that survives worker restarts.
+TABLE_CACHE_DIR = os.getenv("METRICS_TABLE_CACHE_DIR")
+
+
+class RowIndex:
+    """The rows of a metrics table for each tract or visit, so that a
+    row can be found without searching the whole id column.
+
+    Parameters
+    ----------
+    id_col : `str`
+        The name of the id column.
+    ids : `numpy.ndarray`
+        The values of the id column.
+    """
+
+    def __init__(self, id_col, ids):
+        self.id_col = id_col
+        ids = np.asarray(ids)
+        self.order = np.argsort(ids, kind="stable")
+        self.sorted_ids = ids[self.order]
+
+    def convert(self, id_val):
+        """Return an id as the type of the id column, or None if it
+        cannot be one.
+        """
+        try:
+            return np.asarray(id_val).astype(self.sorted_ids.dtype)[()]
+        except (ValueError, OverflowError):
+            return None
+
+    def rows(self, id_val):
+        """Return the rows with an id, in table order.
+
+        Parameters
+        ----------
+        id_val : `int` or `str`
+            The id, which is converted to the type of the id column.
+
+        Returns
+        -------
+        rows : `numpy.ndarray`
+            The row numbers, which is empty if no row has the id.
+        """
+        id_val = self.convert(id_val)
+        if id_val is None:
+            return np.array([], dtype=int)
+        start = np.searchsorted(self.sorted_ids, id_val, side="left")
+        stop = np.searchsorted(self.sorted_ids, id_val, side="right")
+        return np.sort(self.order[start:stop])
+
+
+def index_rows(repo, ref, t):
+    """Index the rows of a loaded table by its id column, if the
+    table has one and it has not been indexed already.
+    """
+    key = (repo, ref.id)
+    if row_index_cache.get(key) is not None:
+        return
+    id_col = table_id_col(ref.datasetType.name, t.colnames)
+    if id_col is not None and id_col in t.colnames:
+        row_index_cache.put(key, RowIndex(id_col, t[id_col]))
+
+
+def get_row_index(repo, ref):
+    """Return the `RowIndex` of a metrics table.
+
+    The index is made when the table is loaded, so if it is missing
+    only the id column is read.
+
+    Returns
+    -------
+    index : `RowIndex` or None
+        The index, or None if the table has no id column.
+    """
+    key = (repo, ref.id)
+    index = row_index_cache.get(key)
+    if index is None:
+        id_col = table_id_col(ref.datasetType.name, table_columns(repo, ref))
+        if id_col is None or id_col not in table_columns(repo, ref):
+            return None
+        index_rows(repo, ref, load_table(repo, ref, [id_col]))
+        index = row_index_cache.get(key)
+    return index
+
+
+def read_parquet_rows(f, columns, id_col, id_val):
+    """Read some columns of the rows of a Parquet file with one id.
+
+    Row groups whose statistics show they cannot hold the id are
+    skipped, so only the row groups with the id are read.
+
+    Parameters
+    ----------
+    f : file-like
+        The open Parquet file.
+    columns : `list` of `str`
+        The columns to read, including ``id_col``.
+    id_col : `str`
+        The name of the id column.
+    id_val : `int` or `str`
+        The id, of the type of the id column.
+
+    Returns
+    -------
+    rows : `pyarrow.Table`
+    """
+    pf = pq.ParquetFile(f)
+    id_n = pf.metadata.schema.names.index(id_col)
+    id_val = id_val.item() if hasattr(id_val, "item") else id_val
+
+    row_groups = []
+    for n in range(pf.num_row_groups):
+        stats = pf.metadata.row_group(n).column(id_n).statistics
+        if stats is not None and stats.has_min_max and not stats.min <= id_val <= stats.max:
+            continue
+        row_group = pf.read_row_group(n, columns=columns)
+        row_groups.append(row_group.filter(pc.equal(row_group[id_col], id_val)))
+
+    if len(row_groups) == 0:
+        return pf.schema_arrow.empty_table().select(columns)
+    return pa.concat_tables(row_groups)
+
+
+def load_rows(repo, ref, columns, index, id_val):
+    """Load some columns of the rows of a metrics table with one id.
+
+    The rows are taken from the loaded table if it is in memory with
+    all the columns, and otherwise only the row groups with the id
+    are read from the datastore.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+    columns : `list` of `str`
+        The columns to load, including the id column.
+    index : `RowIndex`
+        The row index of the table.
+    id_val : `int` or `str`
+        The id.
+
+    Returns
+    -------
+    t : `astropy.table.Table` or None
+        The rows in table order, or None if no row has the id.
+    """
+    rows = index.rows(id_val)
+    if len(rows) == 0:
+        return None
+
+    t = table_cache.get((repo, ref.id))
+    if t is not None and all(col in t.colnames for col in columns):
+        return t[rows]
+
+    uri = request_butler(repo).getURI(ref)
+    with ResourcePath(uri).open("rb") as f:
+        return arrow_to_astropy(read_parquet_rows(f, columns, index.id_col, index.convert(id_val)))
+
+
+def find_table_refs(repo, collection, table_name):
+    """Find the datasets of a metrics table type in a collection.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    collection : `str`
+        Collection to search.
+    table_name : `str`
+        Dataset type name, which may be a glob pattern.
+
+    Returns
+    -------
+    refs : `list` of `lsst.daf.butler.DatasetRef`
+    """
+    key = (repo, collection, table_name)
+    refs = ref_cache.get(key)
+    if refs is None:
+        butler = request_butler(repo)
+        refs = list(butler.registry.queryDatasets(table_name, collections=collection, findFirst=True))
+        ref_cache.put(key, refs)
+    return refs
+
+
+def find_metrics_tables(repo, collection):
+    """Return the last dataset of each metrics table in a collection,
+    keyed by dataset type name.
+    """
+    table_refs = {}
+    for pattern in METRICS_TABLE_PATTERNS:
+        try:
+            refs = find_table_refs(repo, collection, pattern)
+        except MissingDatasetTypeError:
+            refs = []
+        for ref in refs:
+            table_refs[ref.datasetType.name] = ref
+    return table_refs
+
+
+def disk_cache_path(repo, ref):
+    return os.path.join(TABLE_CACHE_DIR, urllib.parse.quote_plus(repo), f"{ref.id}.parq")
+
+
+def read_disk_cache(repo, ref):
+    if TABLE_CACHE_DIR is None:
+        return None
+    path = disk_cache_path(repo, ref)
+    if not os.path.exists(path):
+        return None
+    try:
+        return arrow_to_astropy(pq.read_table(path))
+    except Exception as e:
+        print(f"Could not read cached table {path}: {e}")
+        return None
+
+
+def write_disk_cache(repo, ref, t):
+    if TABLE_CACHE_DIR is None:
+        return
+    path = disk_cache_path(repo, ref)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first, so other workers never
+        # see a partly written file.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(astropy_to_arrow(t), tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Could not write cached table {path}: {e}")
+
+
+def table_columns(repo, ref):
+    """Return the column names of a metrics table without reading it.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+
+    Returns
+    -------
+    columns : `list` of `str`
+    """
+    key = (repo, ref.id)
+    columns = column_cache.get(key)
+    if columns is None:
+        columns = list(request_butler(repo).get(ref.makeComponentRef("columns")))
+        column_cache.put(key, columns)
+    return columns
+
+
+def read_columns(repo, ref, columns):
+    """Read a metrics table from the datastore, optionally only
+    some of its columns.
+    """
+    butler = request_butler(repo)
+    if columns is None:
+        return butler.get(ref)
+    return butler.get(ref, parameters={"columns": list(columns)})
+
+
+def load_table(repo, ref, columns=None):
+    """Load a metrics table, from memory or disk if it has been
+    loaded before and from the datastore otherwise.
+
+    Parameters
+    ----------
+    repo : `str`
+        Butler repository.
+    ref : `lsst.daf.butler.DatasetRef`
+        The metrics table dataset.
+    columns : `list` of `str`, optional
+        Columns to load, which must exist in the table; all of
+        them are loaded if this is None.
+
+    Returns
+    -------
+    t : `astropy.table.Table`
+        The metrics table, which may have more columns than were asked
+        for. It is shared with other requests and must not be modified.
+
+    Notes
+    -----
+    If a cached copy of the table is missing some of the columns, only
+    those columns are read, and they are added to the cached copy.
+    """
+    key = (repo, ref.id)
+    t = table_cache.get(key)
+    from_disk = False
+    if t is None:
+        t = read_disk_cache(repo, ref)
+        from_disk = t is not None
+
+    if t is None:
+        t = read_columns(repo, ref, columns)
+        write_disk_cache(repo, ref, t)
+        # The first time a table is seen its summary goes into the
+        # metric history, made from the columns just read if it can be.
+        colnames = t.colnames if columns is None else column_cache.get(key)
+        record_history_in_background(repo, ref, t, colnames)
+    else:
+        wanted = table_columns(repo, ref) if columns is None else columns
+        missing = [col for col in wanted if col not in t.colnames]
+        if len(missing) == 0 and not from_disk:
+            return t
+        if len(missing) > 0:
+            extra = read_columns(repo, ref, missing)
+            # Add to a new table rather than changing one other
+            # requests may be using.
+            t = t.copy(copy_data=False)
+            t.add_columns([extra[col] for col in missing])
+            write_disk_cache(repo, ref, t)
+
+    index_rows(repo, ref, t)
+    table_cache.put(key, t)
+    return t
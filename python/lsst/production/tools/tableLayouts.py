@@ -0,0 +1,278 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import fnmatch
+
+from .tableSchema import get_schema_index
+
+
+def get_table_layout(table_name):
+    """Return how a metrics table should be laid out as HTML.
+
+    Parameters
+    ----------
+    table_name : `str`
+        The dataset type name of the metrics table.
+
+    Returns
+    -------
+    col_dict : `dict`
+        The columns to show, grouped by how they are formatted.
+    headers : `list`
+        The column headers.
+    prefix : `str`
+        The prefix at the start of the column names.
+
+    Notes
+    -----
+    Returns None for everything if there is no layout for the table.
+    """
+    # Empty string in source cols is for source count
+    if table_name == "calibrate_metadata_metricsTable":
+        prefix = "calexpMetadataMetrics"
+        col_dict = {
+            "id_col": "visit",
+            "table_cols": ["day_obs", "detector", "band", "failed metrics"],
+            "footprint_cols": ["positive", "negative", "sky"],
+            "source_cols": ["", "saturated", "bad"],
+            "mask_cols": [
+                "bad",
+                "cr",
+                "crosstalk",
+                "edge",
+                "intrp",
+                "no_data",
+                "detected",
+                "detected_negative",
+                "sat",
+                "streak",
+                "suspect",
+                "unmasked_nan",
+            ],
+        }
+
+        headers = (
+            ["visit"] + col_dict["table_cols"] + ["footprints", "sources", "masks"]
+        )
+        return col_dict, headers, prefix
+
+    if (
+        table_name == "objectTableCore_metricsTable"
+        or table_name == "object_metrics_table"
+    ):
+        col_dict = {
+            "id_col": "tract",
+            "table_cols": ["corners", "nPatches", "nInputs", "failed metrics"],
+            "shape_cols": ["shapeSizeFractionalDiff", "e1Diff", "e2Diff"],
+            "photom_cols": ["psfCModelScatter"],
+            "stellar_locus_cols": ["yPerp", "wPerp", "xPerp"],
+            "sky_cols": ["skyFluxStatisticMetric"],
+        }
+        prefix = ""
+        headers = ["tract"] + col_dict["table_cols"]
+        for shape_col in col_dict["shape_cols"]:
+            headers.append(shape_col + "<BR>high SN stars")
+            headers.append(shape_col + "<BR>low SN stars")
+        headers += col_dict["stellar_locus_cols"]
+        headers += col_dict["photom_cols"]
+        for col in col_dict["sky_cols"]:
+            headers.append(col + "<BR>mean, stdev")
+            headers.append(col + "<BR>median, sigmaMAD")
+        return col_dict, headers, prefix
+
+    if (
+        table_name == "matchedVisitCore_metricsTable"
+        or table_name == "single_visit_star_association_metrics_table"
+        or table_name == "analysis_source_association_metrics_table"
+        or table_name == "recalibrated_star_association_metrics_table"
+    ):
+        sar_cols = []
+        for num in ["1", "2", "3"]:
+            for stat in ["AM", "AF", "AD"]:
+                sar_cols.append(("stellarAstrometricRepeatability" + num, stat + num))
+
+        col_dict = {
+            "id_col": "tract",
+            "table_cols": ["corners", "failed metrics"],
+            "sasr_cols": ["dmL2AstroErr"],
+            "var1_band_var2": sar_cols
+            + [
+                ("stellarPhotometricRepeatability", "stellarPhotRepeatStdev"),
+                ("stellarPhotometricRepeatability", "stellarPhotRepeatOutlierFraction"),
+                ("stellarPhotometricRepeatability", "ct"),
+                ("stellarPhotometricResidualsCalib", "photResidTractSigmaMad"),
+                ("stellarPhotometricResidualsCalib", "photResidTractStdev"),
+                ("stellarPhotometricResidualsCalib", "photResidTractMedian"),
+            ],
+        }
+        prefix = ""
+        headers = ["tract"] + col_dict["table_cols"]
+        headers += ["Stellar Ast Self Rep"]
+        for line1, line2 in col_dict["var1_band_var2"]:
+            headers.append(line1 + "<BR>" + line2)
+        return col_dict, headers, prefix
+
+    if fnmatch.fnmatch(
+        table_name, "objectTable_tract_*_match_astrom_metricsTable"
+    ) or fnmatch.fnmatch(table_name, "object_ref_match_astrom_metrics_table"):
+        col_dict = {
+            "id_col": "tract",
+            "table_cols": ["corners", "failed metrics"],
+            "var1_band_var2": [
+                ("astromDiffMetrics", "AA1_RA_coadd"),
+                ("astromDiffMetrics", "AA1_sigmaMad_RA_coadd"),
+                ("astromDiffMetrics", "AA1_Dec_coadd"),
+                ("astromDiffMetrics", "AA1_sigmaMad_Dec_coadd"),
+                ("astromDiffMetrics", "AA1_tot_coadd"),
+                ("astromDiffMetrics", "AA1_sigmaMad_tot_coadd"),
+            ],
+        }
+        prefix = ""
+        headers = ["tract"] + col_dict["table_cols"]
+        for line1, line2 in col_dict["var1_band_var2"]:
+            headers.append(line1 + "<BR>" + line2)
+        return col_dict, headers, prefix
+
+    return None, None, None
+
+
+# The columns read by each group of a col_dict, as glob patterns
+# matching the names built by the htmlUtils cell functions.
+TABLE_COL_PATTERNS = {
+    "failed metrics": [],
+    "nPatches": ["coaddPatchCount_*_patchCount"],
+    "nInputs": ["coaddInputCount_*_inputCount_*"],
+}
+
+# Table columns whose values are metrics with thresholds
+METRIC_TABLE_COLS = {"nInputs"}
+
+COLUMN_PATTERNS = {
+    "shape_cols": lambda col, prefix: [f"{col}_*_*SNStars_*"],
+    "stellar_locus_cols": lambda col, prefix: [f"{col}*_{col}_*Flux_*"],
+    "photom_cols": lambda col, prefix: [f"{col}_*_psf_cModel_diff_*"],
+    "sky_cols": lambda col, prefix: [f"{col}_*_*Sky"],
+    "footprint_cols": lambda col, prefix: [f"{prefix}_{col}_footprint_count"],
+    "source_cols": lambda col, prefix: [f"{prefix}_{col}_source_count" if col else f"{prefix}_source_count"],
+    "mask_cols": lambda col, prefix: [f"{prefix}_{col}_mask_fraction"],
+    "sasr_cols": lambda col, prefix: [f"stellarAstrometricSelfRepeatability*_*_{col}_*"],
+    "var1_band_var2": lambda col, prefix: [f"{col[0]}_*_{col[1]}"],
+}
+
+
+def layout_column_patterns(col_dict, prefix):
+    """List the glob patterns of the columns a layout shows.
+
+    Parameters
+    ----------
+    col_dict : `dict`
+        The columns to show, as returned by `get_table_layout`.
+    prefix : `str`
+        The prefix at the start of the column names.
+
+    Returns
+    -------
+    patterns : `list` of `str`
+    """
+    patterns = [col_dict["id_col"]]
+    for col in col_dict["table_cols"]:
+        if col not in METRIC_TABLE_COLS:
+            patterns += TABLE_COL_PATTERNS.get(col, [col])
+    return patterns + layout_metric_patterns(col_dict, prefix)
+
+
+def layout_metric_patterns(col_dict, prefix):
+    """List the glob patterns of the columns a layout checks
+    against the metric thresholds.
+
+    Parameters
+    ----------
+    col_dict : `dict`
+        The columns to show, as returned by `get_table_layout`.
+    prefix : `str`
+        The prefix at the start of the column names.
+
+    Returns
+    -------
+    patterns : `list` of `str`
+    """
+    patterns = []
+    for col in col_dict["table_cols"]:
+        if col in METRIC_TABLE_COLS:
+            patterns += TABLE_COL_PATTERNS[col]
+    for group, make_patterns in COLUMN_PATTERNS.items():
+        for col in col_dict.get(group, []):
+            patterns += make_patterns(col, prefix)
+    return patterns
+
+
+def resolve_columns(columns, patterns):
+    """Select the columns of a table schema that match any pattern.
+
+    Parameters
+    ----------
+    columns : `list` of `str`
+        The column names of the table.
+    patterns : `list` of `str`
+        Glob patterns, or exact column names.
+
+    Returns
+    -------
+    selected : `list` of `str`
+        The matching column names, in table order.
+    """
+    return get_schema_index(columns).resolve(patterns)
+
+
+def table_id_col(table_name, colnames):
+    """Return the name of the id column of a metrics table."""
+    col_dict, _, _ = get_table_layout(table_name)
+    if col_dict is not None:
+        return col_dict["id_col"]
+    for id_col in ["tract", "visit", "detector"]:
+        if id_col in colnames:
+            return id_col
+    return None
+
+
+def layout_metric_columns(columns, table_name, metric_defs):
+    """Return the metric columns of a table: those with thresholds
+    and those shown by the table layout.
+
+    Parameters
+    ----------
+    columns : `list` of `str`
+        The column names of the table.
+    table_name : `str`
+        The dataset type name of the table.
+    metric_defs : `dict`
+        A dictionary of metrics and their thresholds
+
+    Returns
+    -------
+    metric_columns : `list` of `str`
+        The metric column names, in table order.
+    """
+    selected = set(col for col in columns if col in metric_defs)
+    col_dict, _, prefix = get_table_layout(table_name)
+    if col_dict is not None:
+        selected.update(resolve_columns(columns, layout_metric_patterns(col_dict, prefix)))
+    return [col for col in columns if col in selected]
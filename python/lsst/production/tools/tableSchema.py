@@ -0,0 +1,139 @@
+# This file is part of production-tools.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import fnmatch
+import hashlib
+import threading
+
+from .cacheUtils import LRUCache
+
+
+def schema_fingerprint(colnames):
+    """Return a short string identifying a list of column names."""
+    return hashlib.sha1("\n".join(colnames).encode()).hexdigest()
+
+
+class SchemaIndex:
+    """The column names of a metrics table, parsed into metric,
+    band and statistic.
+
+    Metric column names look like ``<metric>_<band>_<statistic>``,
+    where the band is the first single letter section of the name.
+    Columns without a band are indexed with a band of None.
+
+    Parameters
+    ----------
+    colnames : `list` of `str`
+        The column names of the table.
+    """
+
+    def __init__(self, colnames):
+        self.colnames = tuple(colnames)
+        self.fingerprint = schema_fingerprint(self.colnames)
+        self.positions = {name: n for n, name in enumerate(self.colnames)}
+
+        bands = set()
+        # {column name: (metric, band, statistic)}
+        self.parsed = {}
+        # {metric: {band: {statistic: column name}}}
+        self.metrics = {}
+        for name in self.colnames:
+            sections = name.split("_")
+            band_sections = [n for n, section in enumerate(sections) if len(section) == 1]
+            bands.update(sections[n] for n in band_sections)
+            if len(band_sections) == 0:
+                metric, band, statistic = name, None, ""
+            else:
+                n = band_sections[0]
+                metric, band, statistic = "_".join(sections[:n]), sections[n], "_".join(sections[n + 1:])
+            self.parsed[name] = (metric, band, statistic)
+            self.metrics.setdefault(metric, {}).setdefault(band, {})[statistic] = name
+
+        self.bands = sorted(bands)
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def parse(self, name):
+        """Return the metric, band and statistic of a column name."""
+        return self.parsed[name]
+
+    def column(self, metric, band, statistic):
+        """Return the name of a metric column, or None if the table
+        does not have it.
+        """
+        return self.metrics.get(metric, {}).get(band, {}).get(statistic)
+
+    def resolve(self, patterns):
+        """Select the columns that match any of the given patterns.
+
+        Parameters
+        ----------
+        patterns : `list` of `str`
+            Glob patterns, or exact column names.
+
+        Returns
+        -------
+        selected : `list` of `str`
+            The matching column names, in table order.
+
+        Notes
+        -----
+        Results are kept, so each set of patterns is only matched
+        against the schema once.
+        """
+        key = tuple(patterns)
+        with self._lock:
+            selected = self._resolved.get(key)
+        if selected is None:
+            exact = set(pat for pat in patterns if not any(c in pat for c in "*?["))
+            globs = [pat for pat in patterns if pat not in exact]
+            selected = tuple(col for col in self.colnames
+                             if col in exact or any(fnmatch.fnmatchcase(col, pat) for pat in globs))
+            with self._lock:
+                self._resolved[key] = selected
+        return list(selected)
+
+
+schema_indexes = LRUCache(maxsize=256)
+
+
+def get_schema_index(colnames):
+    """Return the `SchemaIndex` of a list of column names, parsing
+    them only the first time a schema is seen.
+
+    Parameters
+    ----------
+    colnames : `list` of `str`
+        The column names of the table.
+
+    Returns
+    -------
+    index : `SchemaIndex`
+    """
+    fingerprint = schema_fingerprint(colnames)
+    index = schema_indexes.get(fingerprint)
+    if index is None:
+        index = SchemaIndex(colnames)
+        schema_indexes.put(fingerprint, index)
+    return index
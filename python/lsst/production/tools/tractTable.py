@@ -19,18 +19,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import fnmatch
+import concurrent.futures
 import os
-import urllib.parse
+import threading
 
-import boto3
-import botocore
 import numpy as np
-import yaml
-from flask import Blueprint, Flask, render_template, url_for
-from lsst.daf.butler import Butler, MissingDatasetTypeError
+from flask import (
+    Blueprint, Flask, Response, current_app, jsonify, render_template, request, stream_template,
+    stream_with_context, url_for
+)
 
+from .butlerPool import release_request_butler
+from .cacheUtils import LRUCache
+from .collectionList import CollectionListing, shorten_repo
 from .htmlUtils import *
+from .metricCompare import compare_tables
+from .metricDefs import get_metric_defs
+from .metricDrillDown import drill_down
+from .metricExport import EXPORT_FORMATS, generate_export
+from .metricHistograms import add_thresholds, get_table_histograms
+from .metricHistory import HISTORY_URI, metric_trend
+from .metricReports import get_failure_masks, metric_report
+from .metricRollups import read_metric_rollups, rollup_rows
+from .metricsTables import find_metrics_tables, find_table_refs, load_table, table_columns
+from .tableLayouts import get_table_layout, layout_column_patterns, resolve_columns, table_id_col
 
 bp = Blueprint(
     "metrics",
@@ -42,178 +54,238 @@ bp = Blueprint(
 REPO_NAMES = os.getenv("BUTLER_REPO_NAMES").split(",")
 
 
-def shorten_repo(repo_name):
+def expand_repo_name(repo):
     """
-    Return the repo name without any '/repo/' prefix
+    Match a repo name without any '/repo/' prefix against REPO_NAMES,
+    returning the full name or None if there is no match.
     """
-    return repo_name.split("/")[-1]
+    if repo in REPO_NAMES:
+        return repo
+    for test_name in REPO_NAMES:
+        if repo == shorten_repo(test_name):
+            return f"/repo/{repo}"
+    return None
+
+
+# Metrics to rank tracts by if none have thresholds
+DEFAULT_WORST_METRICS = [
+    "wPerpCModel_wPerp_cModelFlux_median",
+    "psfCModelScatter_i_psf_cModel_diff_median",
+]
+WORST_PER_METRIC = int(os.getenv("METRICS_WORST_PER_METRIC", "3"))
+WORST_RANKED = int(os.getenv("METRICS_WORST_RANKED", "10"))
+# Number of metrics listed for each table in the failure rollups
+MAX_ROLLUP_METRICS = 20
+
+# The coadd tables the infoPage can summarize, in order of preference
+COADD_SUMMARY_TABLES = ["object_metrics_table", "objectTableCore_metricsTable"]
+
+# The infoPage ranks its tables in parallel, and renders whatever is
+# ready after INFO_PAGE_TIMEOUT seconds. Rankings are kept, so tables
+# that were too slow are shown once they have finished.
+INFO_PAGE_TIMEOUT = float(os.getenv("METRICS_INFO_PAGE_TIMEOUT", "10"))
+info_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("METRICS_INFO_PAGE_THREADS", "4")), thread_name_prefix="info-page"
+)
+# {(repo, dataset id, metric defs key): rank_table summary}
+table_rankings = LRUCache(maxsize=64)
+pending_rankings = {}
+pending_lock = threading.Lock()
+
+collection_listing = CollectionListing(
+    REPO_NAMES, ttl=int(os.getenv("COLLECTION_LISTING_TTL", "60"))
+)
+
+# Cell stores and row orders of the metrics tables, so that each page
+# or chunk of a page only has to format its own rows.
+# The stores refer to the columns of their tables, which they keep in
+# memory after table_cache lets go of them, so they are bounded by size.
+table_store_cache = LRUCache(
+    maxsize=int(os.getenv("METRICS_TABLE_STORE_CACHE_SIZE", "16")),
+    maxbytes=int(os.getenv("METRICS_TABLE_STORE_CACHE_BYTES", str(256 * 1024**2))),
+    sizeof=lambda store: store.nbytes,
+)
+row_order_cache = LRUCache(maxsize=256)
+TABLE_PAGE_SIZE = int(os.getenv("METRICS_TABLE_PAGE_SIZE", "100"))
+MAX_TABLE_PAGE_SIZE = 1000
+TABLE_STREAM_CHUNK = int(os.getenv("METRICS_TABLE_STREAM_CHUNK", "1000"))
 
 
 @bp.route("/")
 def index():
 
-    # collection_names = ["u/sr525/metricsPlotsPDR2_wholeSky"]
+    entries = collection_listing.entries()
+    loading = entries is None
+
     official_collection_entries = []
     user_collection_entries = []
-
-    session = boto3.Session(profile_name="rubin-plot-navigator")
-    s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
-
-    try:
-
-        is_truncated = True
-        marker = ""
-
-        while is_truncated:
-            response = s3_client.list_objects(
-                Bucket="rubin-plot-navigator", Marker=marker
-            )
-            is_truncated = response["IsTruncated"]
-            print(
-                f"Number of responses {len(response['Contents'])} truncated {is_truncated}"
-            )
-            for entry in response["Contents"]:
-                marker = entry["Key"]
-                for repo in REPO_NAMES:
-                    repo_encoded = urllib.parse.quote_plus(repo)
-
-                    if entry["Key"].startswith(repo_encoded):
-                        collection_enc = (
-                            entry["Key"]
-                            .replace(repo_encoded + "/collection_", "", 1)
-                            .replace(".json.gz", "")
-                        )
-                        collection = urllib.parse.unquote(collection_enc)
-
-                        if collection.startswith("u"):
-                            user_collection_entries.append(
-                                {
-                                    "name": collection,
-                                    "updated": entry["LastModified"],
-                                    "repo": shorten_repo(repo),
-                                    "url": urllib.parse.quote(collection, safe=""),
-                                }
-                            )
-                        else:
-                            official_collection_entries.append(
-                                {
-                                    "name": collection,
-                                    "updated": entry["LastModified"],
-                                    "repo": shorten_repo(repo),
-                                    "url": urllib.parse.quote(collection, safe=""),
-                                }
-                            )
-
-    except botocore.exceptions.ClientError as e:
-        print(e)
-
-    official_collection_entries.sort(key=lambda x: x["updated"], reverse=True)
-    user_collection_entries.sort(key=lambda x: x["updated"], reverse=True)
+    for entry in entries or []:
+        if entry["name"].startswith("u"):
+            user_collection_entries.append(entry)
+        else:
+            official_collection_entries.append(entry)
 
     return render_template(
         "metrics/index.html",
         collection_entries=official_collection_entries,
         user_collection_entries=user_collection_entries,
+        loading=loading,
     )
 
 
 @bp.route("/collection/<repo>/<url:collection>/infoPage")
 def infoPage(repo, collection):
-    expanded_repo_name = None
-
-    if repo in REPO_NAMES:
-        expanded_repo_name = repo
-    else:
-        for test_name in REPO_NAMES:
-            if repo == test_name.split("/")[-1]:
-                expanded_repo_name = f"/repo/{repo}"
+    expanded_repo_name = expand_repo_name(repo)
 
     if not expanded_repo_name:
         return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
 
-    butler = Butler(expanded_repo_name)
-
-    try:
-        tables = butler.registry.queryDatasets(
-            "*metrics_table*", collections=collection
-        )
-        table_names = list(set([table.datasetType.name for table in tables]))
-    except MissingDatasetTypeError as e:
-        table_names = []
-
-    if len(table_names) > 0:
-        # This is hacky and assumes that everything has
-        # the same skymap
-        dataId = list(tables)[0].dataId
-
-    session = boto3.Session(profile_name="rubin-plot-navigator")
-    s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
-
-    metric_threshold_filename = "metricInformation.yaml"
-    try:
-        response = s3_client.get_object(
-            Bucket="rubin-plot-navigator", Key=metric_threshold_filename
-        )
-        metric_defs = yaml.safe_load(response["Body"])
-    except botocore.exceptions.ClientError as e:
-        print(e)
-
-    if (
-        "objectTableCore_metricsTable" in table_names
-        or "object_metrics_table" in table_names
-    ):
-        if "object_metrics_table" in table_names:
-            coadd_table_name = "object_metrics_table"
+    table_refs = find_metrics_tables(expanded_repo_name, collection)
+    table_names = sorted(table_refs)
+
+    metric_defs = get_metric_defs()
+
+    # Failure counts made by the cache_metric_rollups job, if it has
+    # been run for this collection with the current thresholds
+    rollups = read_metric_rollups(expanded_repo_name, collection)
+    if rollups is not None and rollups.get("metric_defs_etag") != metric_defs_key(metric_defs):
+        rollups = None
+    table_rollups = rollups["tables"] if rollups is not None else {}
+
+    # This is hacky and assumes that everything has the same skymap
+    coadd_tables = [name for name in COADD_SUMMARY_TABLES if name in table_refs][:1]
+    visit_tables = [name for name in table_names if table_id_col(name, []) == "visit"]
+
+    # The tables are ranked in parallel, and any that take too long
+    # are left out of this page but keep loading for the next one.
+    futures = {}
+    summaries = {}
+    for table_name in coadd_tables + visit_tables:
+        ref = table_refs[table_name]
+        rollup = table_rollups.get(table_name)
+        if rollup is not None and rollup["dataset_id"] == str(ref.id) and "rows" in rollup:
+            # The rollups already have the worst rows, so the table
+            # does not need to be loaded
+            summaries[table_name] = {
+                "table_name": table_name,
+                "id_col": rollup["id_col"],
+                "worst": rollup["worst"],
+                "ranking": rollup["ranking"],
+                "headers": rollup.get("headers", {}),
+                "rows": rollup_rows(rollup),
+            }
         else:
-            coadd_table_name = "objectTableCore_metricsTable"
-        t = butler.get(coadd_table_name, collections=collection, dataId=dataId)
-        metrics = [
-            "wPerpCModel_wPerp_cModelFlux_median",
-            "psfCModelScatter_i_psf_cModel_diff_median",
-        ]
-        worst_coadd, bad_ids = worst(t, metrics, "tract")
-        col_dict = {
-            "id_col": "tract",
-            "table_cols": ["corners", "nPatches", "nInputs", "failed metrics"],
-            "shape_cols": ["shapeSizeFractionalDiff", "e1Diff", "e2Diff"],
-            "photom_cols": ["psfCModelScatter"],
-            "stellar_locus_cols": ["yPerp", "wPerp", "xPerp"],
-            "sky_cols": ["skyFluxStatisticMetric"],
-        }
-        prefix = ""
-        headers = ["tract"] + col_dict["table_cols"]
-        for shape_col in col_dict["shape_cols"]:
-            headers.append(shape_col + "<BR>high SN stars")
-            headers.append(shape_col + "<BR>low SN stars")
-        headers += col_dict["stellar_locus_cols"]
-        headers += col_dict["photom_cols"]
-        for col in col_dict["sky_cols"]:
-            headers.append(col + "<BR>mean, stdev")
-            headers.append(col + "<BR>median, sigmaMAD")
-
-        coadd_headers, bands = make_table_headers(t, headers)
-        coadd_content = make_table_cells(bad_ids, col_dict, bands, metric_defs, prefix)
-
-    else:
-        worst_coadd = []
-        coadd_headers = []
-        coadd_content = {}
-
-    # Currently there are no visit level tables being made
-    worst_visit = []
+            futures[table_name] = submit_ranking(expanded_repo_name, ref, metric_defs)
+
+    # The rankings take their own Butlers from the pool, so give this
+    # request's back rather than hold it while they run.
+    release_request_butler(expanded_repo_name)
+    concurrent.futures.wait(futures.values(), timeout=INFO_PAGE_TIMEOUT)
+    for table_name, future in futures.items():
+        if not future.done():
+            summaries[table_name] = {"table_name": table_name, "status": "loading"}
+        elif future.exception() is not None:
+            print(f"Could not rank {table_name}: {future.exception()}")
+            summaries[table_name] = {"table_name": table_name, "status": "error"}
+        else:
+            summaries[table_name] = future.result()
+
+    for table_name, summary in summaries.items():
+        if "ranking" in summary:
+            # Only list the metrics that come out worst for the worst rows,
+            # in a copy as the summary may be shared through table_rankings
+            ranked_metrics = set(metric for _, _, metric in summary["ranking"])
+            summaries[table_name] = dict(
+                summary, worst=[entry for entry in summary["worst"] if entry[0] in ranked_metrics]
+            )
 
     return render_template(
         "metrics/infoPage.html",
         collection=collection,
         repo=repo,
         tables=table_names,
-        worst_coadd=worst_coadd,
-        coadd_headers=coadd_headers,
-        coadd_content=coadd_content,
-        worst_visit=worst_visit,
+        coadd_summaries=[summaries[name] for name in coadd_tables],
+        visit_summaries=[summaries[name] for name in visit_tables],
+        rollups=rollups,
+        max_rollup_metrics=MAX_ROLLUP_METRICS,
     )
 
 
+def rank_table(repo, ref, metric_defs):
+    """Load a metrics table and rank its rows with `rank_worst`.
+
+    Returns
+    -------
+    summary : `dict`
+        The table name, its id column, the worst values, the ranking,
+        and the headers and cells of the ranked rows for the infoPage.
+    """
+    table_name = ref.datasetType.name
+    col_dict, headers, prefix = get_table_layout(table_name)
+    schema = table_columns(repo, ref)
+    # Rank the rows by every metric with thresholds
+    metrics = [col for col in schema if col in metric_defs]
+    if len(metrics) == 0:
+        metrics = [metric for metric in DEFAULT_WORST_METRICS if metric in schema]
+    columns = resolve_columns(
+        schema, layout_column_patterns(col_dict, prefix) + metrics
+    )
+    t = load_table(repo, ref, columns)
+    worst, ranking, worst_rows = rank_worst(
+        t, metrics, col_dict["id_col"], WORST_PER_METRIC, WORST_RANKED
+    )
+
+    header_dict, bands = make_table_headers(schema, headers)
+    store = make_table_store(t[worst_rows], col_dict, bands, metric_defs, prefix)
+    return {
+        "table_name": table_name,
+        "id_col": col_dict["id_col"],
+        "worst": worst,
+        "ranking": ranking,
+        "headers": header_dict,
+        "rows": make_table_rows(store),
+    }
+
+
+def submit_ranking(repo, ref, metric_defs):
+    """Rank a metrics table with `rank_table` in the infoPage pool.
+
+    Returns
+    -------
+    future : `concurrent.futures.Future`
+        The ranking. A finished future is returned if the table has
+        been ranked before with these thresholds, and the same future
+        if it is still being ranked for another request.
+    """
+    key = (repo, ref.id, metric_defs_key(metric_defs))
+    summary = table_rankings.get(key)
+    if summary is not None:
+        future = concurrent.futures.Future()
+        future.set_result(summary)
+        return future
+
+    with pending_lock:
+        future = pending_rankings.get(key)
+        if future is None:
+            app = current_app._get_current_object()
+            future = info_executor.submit(rank_in_app_context, app, key, repo, ref, metric_defs)
+            pending_rankings[key] = future
+    return future
+
+
+def rank_in_app_context(app, key, repo, ref, metric_defs):
+    # Each ranking has its own app context, so it takes its own
+    # Butler from the pool and gives it back when it is done.
+    try:
+        with app.app_context():
+            summary = rank_table(repo, ref, metric_defs)
+        table_rankings.put(key, summary)
+        return summary
+    finally:
+        with pending_lock:
+            pending_rankings.pop(key, None)
+
+
 @bp.route("/generalTable/<repo>/<url:collection>/<table_name>")
 def generalTable(repo, collection, table_name):
     """Make all the information needed to supply to the template
@@ -231,172 +303,433 @@ def generalTable(repo, collection, table_name):
     environment variable after removing any '/repo/' prefix from
     those names.
     """
-    expanded_repo_name = None
-
-    if repo in REPO_NAMES:
-        expanded_repo_name = repo
-    else:
-        for test_name in REPO_NAMES:
-            if repo == test_name.split("/")[-1]:
-                expanded_repo_name = f"/repo/{repo}"
+    expanded_repo_name = expand_repo_name(repo)
 
     if not expanded_repo_name:
         return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
 
-    butler = Butler(expanded_repo_name)
-
     table_name_short = table_name.split("/")[-1]
-    tables = butler.registry.queryDatasets(table_name, collections=collection)
-    for table in tables:
-        dataId = table.dataId
-    t = butler.get(table_name, collections=collection, dataId=dataId)
-
-    # Empty string in source cols is for source count
-    if table_name == "calibrate_metadata_metricsTable":
-        prefix = "calexpMetadataMetrics"
-        col_dict = {
-            "id_col": "visit",
-            "table_cols": ["day_obs", "detector", "band", "failed metrics"],
-            "footprint_cols": ["positive", "negative", "sky"],
-            "source_cols": ["", "saturated", "bad"],
-            "mask_cols": [
-                "bad",
-                "cr",
-                "crosstalk",
-                "edge",
-                "intrp",
-                "no_data",
-                "detected",
-                "detected_negative",
-                "sat",
-                "streak",
-                "suspect",
-                "unmasked_nan",
-            ],
-        }
-
-        headers = (
-            ["visit"] + col_dict["table_cols"] + ["footprints", "sources", "masks"]
-        )
-
-    if (
-        table_name == "objectTableCore_metricsTable"
-        or table_name == "object_metrics_table"
-    ):
-        col_dict = {
-            "id_col": "tract",
-            "table_cols": ["corners", "nPatches", "nInputs", "failed metrics"],
-            "shape_cols": ["shapeSizeFractionalDiff", "e1Diff", "e2Diff"],
-            "photom_cols": ["psfCModelScatter"],
-            "stellar_locus_cols": ["yPerp", "wPerp", "xPerp"],
-            "sky_cols": ["skyFluxStatisticMetric"],
-        }
-        prefix = ""
-        headers = ["tract"] + col_dict["table_cols"]
-        for shape_col in col_dict["shape_cols"]:
-            headers.append(shape_col + "<BR>high SN stars")
-            headers.append(shape_col + "<BR>low SN stars")
-        headers += col_dict["stellar_locus_cols"]
-        headers += col_dict["photom_cols"]
-        for col in col_dict["sky_cols"]:
-            headers.append(col + "<BR>mean, stdev")
-            headers.append(col + "<BR>median, sigmaMAD")
-
-    if (
-        table_name == "matchedVisitCore_metricsTable"
-        or table_name == "single_visit_star_association_metrics_table"
-        or table_name == "analysis_source_association_metrics_table"
-        or table_name == "recalibrated_star_association_metrics_table"
-    ):
-        sar_cols = []
-        for num in ["1", "2", "3"]:
-            for stat in ["AM", "AF", "AD"]:
-                sar_cols.append(("stellarAstrometricRepeatability" + num, stat + num))
-
-        col_dict = {
-            "id_col": "tract",
-            "table_cols": ["corners", "failed metrics"],
-            "sasr_cols": ["dmL2AstroErr"],
-            "var1_band_var2": sar_cols
-            + [
-                ("stellarPhotometricRepeatability", "stellarPhotRepeatStdev"),
-                ("stellarPhotometricRepeatability", "stellarPhotRepeatOutlierFraction"),
-                ("stellarPhotometricRepeatability", "ct"),
-                ("stellarPhotometricResidualsCalib", "photResidTractSigmaMad"),
-                ("stellarPhotometricResidualsCalib", "photResidTractStdev"),
-                ("stellarPhotometricResidualsCalib", "photResidTractMedian"),
-            ],
-        }
-        prefix = ""
-        headers = ["tract"] + col_dict["table_cols"]
-        headers += ["Stellar Ast Self Rep"]
-        for line1, line2 in col_dict["var1_band_var2"]:
-            headers.append(line1 + "<BR>" + line2)
-
-    if fnmatch.fnmatch(
-        table_name, "objectTable_tract_*_match_astrom_metricsTable"
-    ) or fnmatch.fnmatch(table_name, "object_ref_match_astrom_metrics_table"):
-        col_dict = {
-            "id_col": "tract",
-            "table_cols": ["corners", "failed metrics"],
-            "var1_band_var2": [
-                ("astromDiffMetrics", "AA1_RA_coadd"),
-                ("astromDiffMetrics", "AA1_sigmaMad_RA_coadd"),
-                ("astromDiffMetrics", "AA1_Dec_coadd"),
-                ("astromDiffMetrics", "AA1_sigmaMad_Dec_coadd"),
-                ("astromDiffMetrics", "AA1_tot_coadd"),
-                ("astromDiffMetrics", "AA1_sigmaMad_tot_coadd"),
-            ],
-        }
-        prefix = ""
-        headers = ["tract"] + col_dict["table_cols"]
-        for line1, line2 in col_dict["var1_band_var2"]:
-            headers.append(line1 + "<BR>" + line2)
-
-    session = boto3.Session(profile_name="rubin-plot-navigator")
-    s3_client = session.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
-
-    metric_threshold_filename = "metricInformation.yaml"
-    try:
-        response = s3_client.get_object(
-            Bucket="rubin-plot-navigator", Key=metric_threshold_filename
-        )
-        metric_defs = yaml.safe_load(response["Body"])
-    except botocore.exceptions.ClientError as e:
-        print(e)
+    tables = find_table_refs(expanded_repo_name, collection, table_name)
+    if len(tables) == 0:
+        return {"error": f"No {table_name} in collection {collection}"}, 404
+    col_dict, headers, prefix = get_table_layout(table_name)
+    if col_dict is None:
+        return {"error": f"No table layout for {table_name}"}, 404
+
+    # Only read the columns that the layout shows
+    table_ref = tables[-1]
+    schema = table_columns(expanded_repo_name, table_ref)
+    columns = resolve_columns(schema, layout_column_patterns(col_dict, prefix))
+    t = load_table(expanded_repo_name, table_ref, columns)
+
+    metric_defs = get_metric_defs()
 
     # Make the headers for the table
     # Pulls the bands out of the coadd tables, ignore for visits
-    header_dict, bands = make_table_headers(t, headers)
+    header_dict, bands = make_table_headers(schema, headers)
 
-    # Make the content for the table
-    content_dict = make_table_cells(t, col_dict, bands, metric_defs, prefix)
-    return render_template(
+    # Make the content for the table, which is formatted a chunk
+    # of rows at a time while the page is streamed
+    store = get_table_store(
+        expanded_repo_name, table_ref, t, col_dict, bands, metric_defs, prefix
+    )
+    table_rows = store.iter_rows(chunk_size=TABLE_STREAM_CHUNK)
+    return stream_template(
         "metrics/tracts.html",
         header_dict=header_dict,
-        content_dict=content_dict,
+        table_rows=table_rows,
+        id_col=col_dict["id_col"],
+        repo=repo,
+        collection=collection,
+        table_name=table_name,
+    )
+
+
+def get_table_store(repo, table_ref, t, col_dict, bands, metric_defs, prefix):
+    """Return the `cell_store` for a metrics table, reusing it for
+    as long as the table and thresholds are unchanged.
+    """
+    key = (repo, table_ref.id, metric_defs_key(metric_defs))
+    store = table_store_cache.get(key)
+    if store is None:
+        store = make_table_store(t, col_dict, bands, metric_defs, prefix)
+        table_store_cache.put(key, store)
+    return store
+
+
+def sort_rows(t, num_bad, sort, descending):
+    """Return the row order of a table sorted by a column, or by the
+    number of failed metrics if sort is "failures".
+
+    NaN values sort last in either direction.
+    """
+    if sort == "failures":
+        values = num_bad
+    else:
+        values = t[sort]
+        if hasattr(values, "mask"):
+            values = values.filled(np.nan) if values.dtype.kind == "f" else values.filled()
+        values = np.asarray(values)
+
+    if not descending:
+        return np.argsort(values, kind="stable")
+
+    # Sort the reversed values and reverse the result, which keeps equal
+    # values in table order and works for every dtype, unlike negating.
+    order = (len(values) - 1 - np.argsort(values[::-1], kind="stable"))[::-1]
+    if values.dtype.kind == "f":
+        nan = np.isnan(values[order])
+        order = np.concatenate([order[~nan], order[nan]])
+    return order
+
+
+@bp.route("/api/table/<repo>/<url:collection>/<table_name>")
+def table_page(repo, collection, table_name):
+    """Return one page of the rows of a metrics table as JSON.
+
+    Query parameters:
+
+    page
+        The page to return, counting from 0.
+    page_size
+        The number of rows in a page.
+    sort
+        "failures" to sort by the number of failed metrics, or the
+        name of any column in the table; table order if not given.
+    order
+        "asc" or "desc".
+    failing
+        If true, only include rows with failed metrics.
+
+    The cells of each row have the same text, failure counts,
+    links and debug groups as the generalTable page.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
+
+    page = max(request.args.get("page", 0, type=int), 0)
+    page_size = min(max(request.args.get("page_size", TABLE_PAGE_SIZE, type=int), 1), MAX_TABLE_PAGE_SIZE)
+    sort = request.args.get("sort")
+    descending = request.args.get("order", "asc") == "desc"
+    failing = request.args.get("failing", "false").lower() in ("1", "true", "yes")
+
+    tables = find_table_refs(expanded_repo_name, collection, table_name)
+    if len(tables) == 0:
+        return {"error": f"No {table_name} in collection {collection}"}, 404
+    col_dict, headers, prefix = get_table_layout(table_name)
+    if col_dict is None:
+        return {"error": f"No table layout for {table_name}"}, 404
+
+    table_ref = tables[-1]
+    schema = table_columns(expanded_repo_name, table_ref)
+    if sort is not None and sort != "failures" and sort not in schema:
+        return {"error": f"No column {sort} in {table_name}"}, 400
+    columns = resolve_columns(schema, layout_column_patterns(col_dict, prefix))
+    if sort is not None and sort != "failures" and sort not in columns:
+        columns.append(sort)
+    t = load_table(expanded_repo_name, table_ref, columns)
+
+    metric_defs = get_metric_defs()
+    header_dict, bands = make_table_headers(schema, headers)
+    store = get_table_store(
+        expanded_repo_name, table_ref, t, col_dict, bands, metric_defs, prefix
+    )
+    num_bad = store.num_bad
+
+    order_key = (expanded_repo_name, table_ref.id, metric_defs_key(metric_defs), sort, descending, failing)
+    order = row_order_cache.get(order_key)
+    if order is None:
+        order = np.arange(len(t)) if sort is None else sort_rows(t, num_bad, sort, descending)
+        if failing:
+            order = order[num_bad[order] > 0]
+        row_order_cache.put(order_key, order)
+
+    rows = order[page * page_size:(page + 1) * page_size]
+    table_rows = make_table_rows(store, rows)
+
+    return jsonify({
+        "table_name": table_name,
+        "collection": collection,
+        "headers": list(header_dict),
+        "total": len(order),
+        "page": page,
+        "page_size": page_size,
+        "rows": [
+            {
+                "id": str(id_val),
+                "failures": int(num_bad[n]),
+                "cells": [vars(cell) for cell in row_list[1:]],
+            }
+            for n, (id_val, row_list) in zip(rows.tolist(), table_rows)
+        ],
+    })
+
+
+@bp.route("/api/export/<repo>/<url:collection>/<table_name>")
+def export_table(repo, collection, table_name):
+    """Stream a metrics table as CSV or Parquet, with a failure flag
+    for each metric with thresholds.
+
+    Query parameters:
+
+    format
+        "csv" or "parquet".
+    column
+        A column to export; may be given more than once. By default
+        the columns of the generalTable page are exported, or every
+        column if the table has no layout.
+
+    Each thresholded column gets a ``<column>_fail`` flag, and
+    ``n_failed_metrics`` counts the flags set in each row. The file
+    is written a batch of rows at a time as it is sent.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
+
+    export_format = request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        return {"error": f"Invalid export format {export_format}"}, 400
+
+    tables = find_table_refs(expanded_repo_name, collection, table_name)
+    if len(tables) == 0:
+        return {"error": f"No {table_name} in collection {collection}"}, 404
+
+    table_ref = tables[-1]
+    schema = table_columns(expanded_repo_name, table_ref)
+    columns = request.args.getlist("column")
+    missing = [col for col in columns if col not in schema]
+    if len(missing) > 0:
+        return {"error": f"No columns {', '.join(missing)} in {table_name}"}, 400
+    if len(columns) == 0:
+        col_dict, _, prefix = get_table_layout(table_name)
+        if col_dict is None:
+            columns = schema
+        else:
+            columns = resolve_columns(schema, layout_column_patterns(col_dict, prefix))
+    t = load_table(expanded_repo_name, table_ref, columns)
+
+    metric_defs = get_metric_defs()
+    failure_masks = get_failure_masks(
+        expanded_repo_name, table_ref, [col for col in columns if col in metric_defs], metric_defs
+    )
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f"{collection.replace('/', '_')}_{table_name}.{extension}"
+    return Response(
+        stream_with_context(generate_export(t, columns, failure_masks, export_format)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+@bp.route("/api/compare/<repo>/<table_name>")
+def compare_collections(repo, table_name):
+    """Compare a metrics table in two collections row by row, as JSON.
+
+    Query parameters:
+
+    base
+        The collection of the earlier run.
+    new
+        The collection of the run to check.
+    metric
+        A metric column to compare; may be given more than once. By
+        default every column with thresholds is compared.
+    n
+        The number of regressions to return.
+
+    The rows are matched on the id column of the table layout, and on
+    detector as well when both tables have one.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}"}, 404
+
+    base_collection = request.args.get("base")
+    new_collection = request.args.get("new")
+    if base_collection is None or new_collection is None:
+        return {"error": "Both base and new collections are needed"}, 400
+    n_worst = min(max(request.args.get("n", 20, type=int), 1), 1000)
+
+    col_dict, _, _ = get_table_layout(table_name)
+    if col_dict is None:
+        return {"error": f"No table layout for {table_name}"}, 404
+
+    refs = {}
+    schemas = {}
+    for collection in [base_collection, new_collection]:
+        tables = find_table_refs(expanded_repo_name, collection, table_name)
+        if len(tables) == 0:
+            return {"error": f"No {table_name} in collection {collection}"}, 404
+        refs[collection] = tables[-1]
+        schemas[collection] = set(table_columns(expanded_repo_name, tables[-1]))
+    shared = schemas[base_collection] & schemas[new_collection]
+
+    metric_defs = get_metric_defs()
+    metric_list = request.args.getlist("metric")
+    if len(metric_list) == 0:
+        metric_list = [col for col in table_columns(expanded_repo_name, refs[new_collection])
+                       if col in metric_defs and col in shared]
+    missing = [metric for metric in metric_list if metric not in shared]
+    if len(missing) > 0:
+        return {"error": f"Not in both tables: {', '.join(missing)}"}, 400
+
+    key_cols = [col_dict["id_col"]]
+    if col_dict["id_col"] != "detector" and "detector" in shared:
+        key_cols.append("detector")
+
+    # Only the keys and the compared metrics are read
+    base = load_table(expanded_repo_name, refs[base_collection], key_cols + metric_list)
+    new = load_table(expanded_repo_name, refs[new_collection], key_cols + metric_list)
+
+    comparison = compare_tables(base, new, key_cols, metric_list, metric_defs, n_worst)
+    comparison.update({"table_name": table_name, "base": base_collection, "new": new_collection})
+    return jsonify(comparison)
+
+
+@bp.route("/api/trend/<repo>/<table_name>")
+def metric_trend_page(repo, table_name):
+    """The history of a metric across runs, as JSON.
+
+    Query parameters:
+
+    metric
+        A column name, or a metric name to return every band and
+        statistic of.
+    band
+        Only return this band.
+    statistic
+        Only return this statistic.
+
+    Only runs whose tables have been loaded since the history was
+    enabled are included.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}"}, 404
+    if HISTORY_URI is None:
+        return {"error": "No metric history is kept"}, 404
+
+    metric = request.args.get("metric")
+    if metric is None:
+        return {"error": "A metric is needed"}, 400
+
+    points = metric_trend(expanded_repo_name, table_name, metric,
+                          request.args.get("band"), request.args.get("statistic"))
+    for point in points:
+        point["recorded"] = point["recorded"].isoformat()
+    return jsonify({"table_name": table_name, "metric": metric, "points": points})
+
+
+@bp.route("/histograms/<repo>/<url:collection>/<table_name>")
+def histograms(repo, collection, table_name):
+    """The histograms of every metric in a metrics table.
+
+    The page itself is empty; the histograms are fetched from
+    `table_histograms_json` and drawn in the browser.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
+
+    return render_template(
+        "metrics/histograms.html",
+        repo=repo,
         collection=collection,
         table_name=table_name,
     )
 
 
-@bp.route("/histograms/<collection_name>")
-def histograms(collection_name):
+@bp.route("/api/histograms/<repo>/<url:collection>/<table_name>")
+def table_histograms_json(repo, collection, table_name):
+    """Return the histogram of each numeric column of a metrics table,
+    with the thresholds of its metric, as JSON.
+
+    The histograms are made the first time a table is seen and kept
+    for each dataset, so only the thresholds are looked up after that.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
+
+    tables = find_table_refs(expanded_repo_name, collection, table_name)
+    if len(tables) == 0:
+        return {"error": f"No {table_name} in collection {collection}"}, 404
+    table_ref = tables[-1]
+
+    histograms = add_thresholds(get_table_histograms(expanded_repo_name, table_ref), get_metric_defs())
+    return jsonify({
+        "table_name": table_name,
+        "dataset_id": str(table_ref.id),
+        "histograms": histograms,
+    })
+
+
+@bp.route("/tract/<repo>/<url:collection>/<tract>")
+def single_tract(repo, collection, tract):
+    """Every metric of one tract, or of one visit with
+    ``?id_col=visit``, from each metrics table in the collection,
+    along with its plots.
+
+    Rows are found with the row index of each table, so only the
+    rows of the tract are taken from the metric columns.
+    """
+    expanded_repo_name = expand_repo_name(repo)
+
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
 
-    bands = ["g", "r", "i", "z", "y"]
+    id_col = request.args.get("id_col", "tract")
+    tables, plots = drill_down(expanded_repo_name, collection, id_col, tract, get_metric_defs())
 
-    return render_template("metrics/histograms.html")
+    return render_template(
+        "metrics/single_tract.html",
+        repo=repo,
+        expanded_repo_name=expanded_repo_name,
+        collection=collection,
+        tract=tract,
+        id_col=id_col,
+        tables=tables,
+        plots=plots,
+    )
 
 
-@bp.route("/tract/<collection_name>/<tract>")
-def single_tract(collection_name, tract):
+@bp.route("/report/<repo>/<url:collection>/<table_name>/<metric>")
+def report_page(repo, collection, table_name, metric):
+    """The tracts or visits of a metrics table that fail a metric,
+    most severe first.
 
-    collection_name = urllib.parse.unquote(collection_name)
+    The metric can be a column with thresholds, or a debug group from
+    the metric definitions, in which case every column of the group
+    is included. The failures of each column are found once per
+    dataset and thresholds, and kept.
+    """
+    expanded_repo_name = expand_repo_name(repo)
 
-    return render_template("metrics/single_tract.html", tract=tract)
+    if not expanded_repo_name:
+        return {"error": f"Invalid repo name {repo}, collection {collection}"}, 404
 
+    tables = find_table_refs(expanded_repo_name, collection, table_name)
+    if len(tables) == 0:
+        return {"error": f"No {table_name} in collection {collection}"}, 404
 
-@bp.route("/report/<collection_name>/<metric>")
-def report_page(collection_name, metric):
+    report = metric_report(expanded_repo_name, tables[-1], metric, get_metric_defs())
+    if report is None:
+        return {"error": f"No thresholded metric {metric} in {table_name}"}, 404
 
-    return render_template("metrics/report_page.html")
+    return render_template(
+        "metrics/report_page.html",
+        repo=repo,
+        collection=collection,
+        table_name=table_name,
+        metric=metric,
+        report=report,
+    )
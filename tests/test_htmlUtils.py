@@ -0,0 +1,267 @@
+import io
+import json
+import os
+from unittest import mock
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from astropy.table import Table
+
+
+def make_object_table(n_rows):
+    rng = np.random.default_rng(0)
+    t = Table()
+    t["tract"] = np.arange(n_rows)
+    t["corners"] = [f"corner{i}" for i in range(n_rows)]
+    for band in ["g", "r"]:
+        t[f"coaddPatchCount_{band}_patchCount"] = rng.integers(1, 50, n_rows).astype(float)
+        t[f"coaddInputCount_{band}_inputCount_median"] = rng.normal(10, 2, n_rows)
+        t[f"coaddInputCount_{band}_inputCount_sigmaMad"] = rng.normal(1, 0.2, n_rows)
+        for sn in ["highSNStars", "lowSNStars"]:
+            t[f"e1Diff_{band}_{sn}_median"] = rng.normal(0, 0.01, n_rows)
+            t[f"e1Diff_{band}_{sn}_sigmaMad"] = rng.normal(0.01, 0.002, n_rows)
+        t[f"psfCModelScatter_{band}_psf_cModel_diff_median"] = rng.normal(0, 0.02, n_rows)
+        for stat in ["meanSky", "stdevSky", "medianSky", "sigmaMADSky"]:
+            t[f"skyFluxStatisticMetric_{band}_{stat}"] = rng.normal(0, 1, n_rows)
+    for col in ["yPerp", "wPerp"]:
+        t[f"{col}CModel_{col}_cModelFlux_median"] = rng.normal(0, 0.01, n_rows)
+        t[f"{col}CModel_{col}_cModelFlux_sigmaMAD"] = rng.normal(0.01, 0.002, n_rows)
+    t["e1Diff_g_highSNStars_median"][::5] = np.nan
+    t["e1Diff_r_lowSNStars_sigmaMad"][1::7] = np.nan
+    return t
+
+
+def test_table_cells():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.htmlUtils import (
+            get_metric_plan, make_table_cells, make_table_cells_per_row, make_table_headers,
+            make_table_rows, make_table_store
+        )
+        from lsst.production.tools.tableLayouts import get_table_layout
+
+    col_dict, headers, prefix = get_table_layout("object_metrics_table")
+    t = make_object_table(50)
+    metric_defs = {
+        "e1Diff_g_highSNStars_median": {"lowThreshold": -0.01, "highThreshold": 0.01, "debugGroup": "shape"},
+        "e1Diff_r_lowSNStars_sigmaMad": {"lowThreshold": 0.0, "highThreshold": 0.011, "debugGroup": "shape"},
+        "coaddInputCount_g_inputCount_median": {"lowThreshold": 8, "highThreshold": 100, "debugGroup": "inputs"},
+        "wPerpCModel_wPerp_cModelFlux_median": {"lowThreshold": -0.01, "highThreshold": 0.01, "debugGroup": "locus"},
+    }
+    _, bands = make_table_headers(t, headers)
+
+    per_row = make_table_cells_per_row(t, col_dict, bands, metric_defs, prefix)
+    columnar = make_table_cells(t, col_dict, bands, metric_defs, prefix)
+
+    assert per_row.keys() == columnar.keys()
+    for key in per_row:
+        assert [vars(cell) for cell in per_row[key]] == [vars(cell) for cell in columnar[key]]
+    assert any(int(row[4].text) > 0 for row in columnar.values())
+
+    # A page of rows only formats those rows, with the same cells
+    store = make_table_store(t, col_dict, bands, metric_defs, prefix)
+    assert store.nbytes >= store.num_fails.nbytes + np.asarray(t["e1Diff_g_highSNStars_median"]).nbytes
+    page = make_table_rows(store, [30, 2])
+    assert [str(id_val) for id_val, _ in page] == ["30", "2"]
+    for id_val, row_list in page:
+        assert [vars(cell) for cell in row_list] == [vars(cell) for cell in per_row[str(id_val)]]
+
+    plan = get_metric_plan(t.colnames, col_dict, metric_defs, prefix)
+    assert get_metric_plan(list(t.colnames), col_dict, dict(metric_defs), prefix) is plan
+    assert "wPerpCModel_wPerp_cModelFlux_median" in plan.names
+    assert "corners" not in plan.names
+
+
+def test_worst():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.htmlUtils import rank_worst, worst
+
+    t = make_object_table(100)
+    t["e1Diff_g_highSNStars_median"][7] = 1.0
+    t["psfCModelScatter_r_psf_cModel_diff_median"][12] = -1.0
+    metrics = ["e1Diff_g_highSNStars_median", "psfCModelScatter_r_psf_cModel_diff_median"]
+
+    worst_rows, bad_table = worst(t, metrics, "tract")
+    assert [row[2] for row in worst_rows] == [7, 12]
+    assert list(bad_table["tract"]) == [7, 12]
+
+    per_metric, ranking, rows = rank_worst(t, metrics, "tract", k=3, n_ranked=5)
+    assert len(per_metric) == 6
+    assert [row[2] for row in per_metric[::3]] == [7, 12]
+    assert len(ranking) == 5
+    assert ranking[0][0] == 7 and ranking[0][2] == metrics[0]
+    assert rows[:2] == [7, 12]
+
+
+def test_schema_index():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.tableSchema import get_schema_index
+
+    colnames = make_object_table(1).colnames
+    index = get_schema_index(colnames)
+    assert get_schema_index(list(colnames)) is index
+    assert index.bands == ["g", "r"]
+    assert index.column("e1Diff", "r", "lowSNStars_sigmaMad") == "e1Diff_r_lowSNStars_sigmaMad"
+    assert index.column("e1Diff", "i", "lowSNStars_sigmaMad") is None
+    assert index.column("tract", None, "") == "tract"
+    assert index.resolve(["tract", "e1Diff_g_*_median"]) == [
+        "tract", "e1Diff_g_highSNStars_median", "e1Diff_g_lowSNStars_median"
+    ]
+
+
+def test_compare_tables():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricCompare import compare_tables
+
+    metric = "e1Diff_g_lowSNStars_median"
+    base = make_object_table(20)
+    new = base[5:].copy()
+    new[metric] = 0.0
+    new[metric][3] = 0.5
+    metric_defs = {metric: {"lowThreshold": -0.1, "highThreshold": 0.1, "debugGroup": "shape"}}
+
+    comparison = compare_tables(base, new, ["tract"], [metric], metric_defs, n_worst=5)
+    assert comparison["n_matched"] == 15
+    assert comparison["n_base_only"] == 5
+    assert comparison["n_new_failures"] == 1
+    assert comparison["regressions"][0]["key"] == {"tract": 8}
+    assert comparison["regressions"][0]["new"] == 0.5
+
+
+def test_table_histograms():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricHistograms import histogram_columns, table_histograms
+
+    t = make_object_table(200)
+    t["skyFluxStatisticMetric_g_meanSky"][:] = np.nan
+    t["skyFluxStatisticMetric_r_meanSky"][:] = 3.0
+    columns = histogram_columns(t)
+    assert "tract" not in columns and "corners" not in columns
+
+    # Every column is binned at once, as numpy.histogram would
+    for histogram in table_histograms(t, columns, n_bins=10):
+        values = np.asarray(t[histogram["column"]], dtype=float)
+        values = values[np.isfinite(values)]
+        expected, _ = np.histogram(values, bins=10, range=histogram["range"])
+        assert histogram["counts"] == expected.tolist()
+        assert sum(histogram["counts"]) + histogram["n_below"] + histogram["n_above"] == len(values)
+        assert histogram["n_nan"] == len(t) - len(values)
+
+
+def test_row_index():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricsTables import RowIndex
+
+    visits = np.array([7, 3, 7, 5, 3, 7])
+    index = RowIndex("visit", visits)
+    assert index.rows(7).tolist() == [0, 2, 5]
+    assert index.rows("3").tolist() == [1, 4]
+    assert index.rows(4).tolist() == []
+    assert index.rows("abc").tolist() == []
+    assert index.rows("99999999999999999999").tolist() == []
+
+
+def test_read_parquet_rows():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricsTables import read_parquet_rows
+
+    t = make_object_table(100)
+    metric = "e1Diff_g_highSNStars_median"
+    t["visit"] = np.repeat(np.arange(10), 10)
+    buffer = io.BytesIO()
+    pq.write_table(pa.table({"visit": np.asarray(t["visit"]), metric: np.asarray(t[metric])}),
+                   buffer, row_group_size=10)
+
+    rows = read_parquet_rows(io.BytesIO(buffer.getvalue()), ["visit", metric], "visit", np.int64(4))
+    assert rows["visit"].to_pylist() == [4] * 10
+    np.testing.assert_array_equal(rows[metric].to_numpy(), np.asarray(t[metric][40:50]))
+    assert read_parquet_rows(io.BytesIO(buffer.getvalue()), ["visit"], "visit", 12).num_rows == 0
+
+
+def test_failure_mask():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricReports import FailureMask, report_columns
+
+    values = np.array([0.5, 2.0, np.nan, -1.5, 1.0, 0.0])
+    mask = FailureMask(values, 0.0, 1.0)
+    assert mask.mask.tolist() == [False, True, False, True, False, False]
+    # -1.5 is further outside than 2.0
+    assert mask.rows.tolist() == [3, 1]
+    assert mask.severity.tolist() == [1.5, 1.0]
+
+    metric_defs = {
+        "e1Diff_g_highSNStars_median": {"lowThreshold": -0.01, "highThreshold": 0.01, "debugGroup": "shape"},
+        "e1Diff_r_lowSNStars_sigmaMad": {"lowThreshold": 0.0, "highThreshold": 0.011, "debugGroup": "shape"},
+        "wPerpCModel_wPerp_cModelFlux_median": {"lowThreshold": -0.01, "highThreshold": 0.01},
+    }
+    colnames = make_object_table(1).colnames
+    assert report_columns("shape", colnames, metric_defs) == [
+        "e1Diff_g_highSNStars_median", "e1Diff_r_lowSNStars_sigmaMad"
+    ]
+    assert report_columns("wPerpCModel_wPerp_cModelFlux_median", colnames, metric_defs) == [
+        "wPerpCModel_wPerp_cModelFlux_median"
+    ]
+
+
+def test_export():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.metricExport import export_batches, generate_csv, generate_parquet
+        from lsst.production.tools.metricReports import FailureMask
+
+    t = make_object_table(25)
+    metric = "e1Diff_g_highSNStars_median"
+    masks = {metric: FailureMask(np.asarray(t[metric]), -0.01, 0.01)}
+    columns = ["tract", metric]
+
+    batches = list(export_batches(t, columns, masks, batch_rows=10))
+    assert [batch.num_rows for batch in batches] == [10, 10, 5]
+    assert batches[0].column_names == ["tract", metric, f"{metric}_fail", "n_failed_metrics"]
+
+    parquet = pq.read_table(io.BytesIO(b"".join(generate_parquet(iter(batches)))))
+    assert parquet.num_rows == 25
+    assert parquet[f"{metric}_fail"].to_pylist() == masks[metric].mask.tolist()
+
+    lines = b"".join(generate_csv(iter(batches))).decode().splitlines()
+    assert len(lines) == 26
+    assert lines[0].startswith('"tract"')
+
+
+def test_sort_rows():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.tractTable import sort_rows
+
+    t = Table()
+    t["count"] = np.array([0, 5, 2, 5], dtype=np.uint32)
+    t["flag"] = [True, False, True, False]
+    t["value"] = [1.0, np.nan, 3.0, 1.0]
+    assert sort_rows(t, None, "count", True).tolist() == [1, 3, 2, 0]
+    assert sort_rows(t, None, "flag", True).tolist() == [0, 2, 1, 3]
+    assert sort_rows(t, None, "value", True).tolist() == [2, 0, 3, 1]
+    assert sort_rows(t, None, "value", False).tolist() == [0, 3, 2, 1]
+
+
+def test_rollup_rows():
+    with mock.patch.dict(os.environ, {"BUTLER_REPO_NAMES": "testrepo"}):
+        from lsst.production.tools.htmlUtils import make_table_rows, make_table_store, rank_worst
+        from lsst.production.tools.metricRollups import rollup_rows, rollup_table
+        from lsst.production.tools.tableLayouts import get_table_layout
+
+    layout = get_table_layout("object_metrics_table")
+    t = make_object_table(50)
+    metric_defs = {
+        "e1Diff_g_highSNStars_median": {"lowThreshold": -0.01, "highThreshold": 0.01, "debugGroup": "shape"},
+        "wPerpCModel_wPerp_cModelFlux_median": {"lowThreshold": -0.01, "highThreshold": 0.01, "debugGroup": "locus"},
+    }
+    metrics = list(metric_defs)
+
+    rollup = json.loads(json.dumps(rollup_table(t, metrics, "tract", metric_defs, layout=(layout, t.colnames))))
+    _, _, worst_rows = rank_worst(t, metrics, "tract", 3, 10)
+    col_dict, _, prefix = layout
+    expected = make_table_rows(make_table_store(t[worst_rows], col_dict, ["g", "r"], metric_defs, prefix))
+
+    assert list(rollup["headers"])[0] == "tract"
+    assert rollup["bands"] == {"g": {"n_fail": rollup["metrics"][metrics[0]]["n_fail"], "n_metrics": 1},
+                               "none": {"n_fail": rollup["metrics"][metrics[1]]["n_fail"], "n_metrics": 1}}
+    assert [id_val for id_val, _ in rollup_rows(rollup)] == [int(id_val) for id_val, _ in expected]
+    for (_, cells), (_, expected_cells) in zip(rollup_rows(rollup), expected):
+        assert [vars(cell) for cell in cells] == [vars(cell) for cell in expected_cells]
@@ -1,5 +1,6 @@
 
 import os
+import time
 import pytest
 from unittest import mock
 from unittest.mock import patch
@@ -56,3 +57,109 @@ def test_image_metadata(mock, client):
     assert response_md.status_code == 200
     assert len(response_md.json['boxes']) > 0
 
+
+
+def test_read_png_metadata():
+
+    from lsst.production.tools.images import read_png_metadata
+    from lsst.resources import ResourcePath
+
+    uuid = "04e7c0fb-40e7-4a07-9e2a-cc9987282923"
+    metadata = read_png_metadata(ResourcePath(f"test_data/{uuid}.png"))
+
+    assert metadata['has_metadata']
+    assert len(metadata['boxes']) > 0
+    assert metadata['width'] > 0 and metadata['height'] > 0
+
+
+@patch("lsst.production.tools.images.get_butler_map")
+def test_image_metadata_index(mock_butler, client):
+
+    uuid = "04e7c0fb-40e7-4a07-9e2a-cc9987282923"
+    summary = {"tracts": {"plotType": [{"dataId": "{}", "id": uuid, "has_metadata": True,
+                                        "label": "indexed", "boxes": "[]",
+                                        "width": 10, "height": 10}]},
+               "visits": {}, "global": {}}
+
+    with patch("lsst.production.tools.cache.read_collection_summary", return_value=summary):
+        response_md = client.get(f"/plot-navigator/images/uuid_md/testrepo/{uuid}",
+                                 query_string={"collection": "u/test/indexed"})
+
+    assert response_md.status_code == 200
+    assert response_md.json['label'] == "indexed"
+    mock_butler.assert_not_called()
+
+
+@patch("lsst.production.tools.images.get_butler_map", return_value=MockButler())
+def test_contact_sheet(mock, client):
+
+    uuid = "04e7c0fb-40e7-4a07-9e2a-cc9987282923"
+    query = {"uuid": f"{uuid},{uuid}", "tile": 64}
+
+    response = client.get("/plot-navigator/images/sheet/testrepo", query_string=query)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+
+    response_md = client.get("/plot-navigator/images/sheet_md/testrepo", query_string=query)
+    assert response_md.status_code == 200
+    tiles = response_md.json['tiles']
+    assert len(tiles) == 2
+    assert tiles[1]['x'] >= 64
+    assert max(tiles[0]['width'], tiles[0]['height']) == 64
+
+    response_bad = client.get("/plot-navigator/images/sheet/testrepo")
+    assert response_bad.status_code == 400
+
+
+@patch("lsst.production.tools.images.get_butler_map", return_value=MockButler())
+def test_image_rendition(mock, client):
+
+    from lsst.production.tools import images
+
+    uuid = "04e7c0fb-40e7-4a07-9e2a-cc9987282923"
+    headers = {"Accept": "image/webp,*/*"}
+
+    # The first request gets the original and queues the rendition.
+    response = client.get(f"/plot-navigator/images/uuid/testrepo/{uuid}", headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+
+    for _ in range(100):
+        if not images.pending_renditions:
+            break
+        time.sleep(0.05)
+    response = client.get(f"/plot-navigator/images/uuid/testrepo/{uuid}", headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Has-Metadata'] == "true"
+    assert "Accept" in response.headers['Vary']
+
+    stats = client.get("/plot-navigator/images/renditions").json
+    assert stats['webp']['count'] == 1
+
+
+@patch("lsst.production.tools.images.get_butler_map", return_value=MockButler())
+def test_archive(mock, client):
+
+    import io
+    import tarfile
+    import zipfile
+
+    uuid = "04e7c0fb-40e7-4a07-9e2a-cc9987282923"
+    summary = {"tracts": {"plotType": [{"dataId": '{"skymap": "sky", "tract": 1}', "id": uuid},
+                                       {"dataId": '{"skymap": "sky", "tract": 2}', "id": uuid}]},
+               "visits": {}, "global": {}}
+
+    with patch("lsst.production.tools.cache.read_collection_summary", return_value=summary):
+        response = client.get("/plot-navigator/images/archive/testrepo/plotType",
+                              query_string={"collection": "u/test/archive"})
+        assert response.status_code == 200
+        names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+        assert names == [f"plotType/1_{uuid}.png", f"plotType/2_{uuid}.png"]
+
+        response = client.get("/plot-navigator/images/archive/testrepo/plotType",
+                              query_string={"collection": "u/test/archive", "format": "tar"})
+        assert len(tarfile.open(fileobj=io.BytesIO(response.data)).getnames()) == 2
+
+        response = client.get("/plot-navigator/images/archive/testrepo/missingType",
+                              query_string={"collection": "u/test/archive"})
+        assert response.status_code == 404